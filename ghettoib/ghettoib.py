@@ -2,12 +2,29 @@
 import serial
 import array
 import io
+import os
 import sys
 import time
 import Image
 import cStringIO
 import struct
-import inspect
+import json
+import shutil
+import tempfile
+import hashlib
+import base64
+import select
+import socket
+try:
+	import fcntl
+	import termios
+except ImportError: # Windows, where only the pySerial and TCP transports work
+	fcntl = termios = None
+import logging
+import threading
+import Queue
+import contextlib
+import collections
 from datetime import datetime
 
 """
@@ -46,36 +63,497 @@ Read the included README.txt for usage information and command summary.
 
 
 
+log = logging.getLogger("ghettoib")
+
+class ColorHandler(logging.StreamHandler):
+	"""Logging handler that prints the messages of HPLA.dbg() on the console with the
+	time, the calling method and the message in its ANSI color. HPLA adds one to the
+	"ghettoib" logger when debugging and logging hasn't been set up otherwise."""
+
+	COLORS = dict(cyan = '\033[96m',
+		 magenta= '\033[95m',
+		 blue = '\033[94m',
+		 yellow = '\033[93m',
+		 green = '\033[92m',
+		 red = '\033[91m',
+		 end = '\033[0m')
+
+	def __init__(self, stream = sys.stdout, color = True):
+		logging.StreamHandler.__init__(self, stream)
+		self.color = color
+
+	def format(self, record):
+		msg = record.getMessage()
+		color = getattr(record, "color", None)
+		if self.color and color in self.COLORS:
+			msg = self.COLORS[color] + msg + self.COLORS["end"]
+		return "[" + str(record.created) + "\t" + getattr(record, "source", record.funcName) + "]\t" + msg
+
+
+class HPLATimeout(Exception):
+	"""Raised when the instrument doesn't respond in time."""
+	pass
+
+class HPLARemoteError(Exception):
+	"""Raised by HPLAClient when a call failed in the server."""
+	pass
+
+class HPLACancelled(Exception):
+	"""Raised for a call that was cancelled before it ran."""
+	pass
+
+class QueryCaptured(Exception):
+	"""Raised internally by HPLA.pipeline() to stop a query method once its command
+	has been recorded."""
+	pass
+
+
+# Transports
+
+class Transport(object):
+	"""Byte stream between the controller and the instrument.
+
+	A transport implements the part of the pySerial interface HPLA uses, with the same
+	semantics: read(size) blocks until 'size' bytes have arrived or 'timeout' seconds
+	have passed, inWaiting() returns the number of bytes that can be read immediately
+	and wait(timeout) blocks until there is something to read. HPLA does its own
+	buffering on top of this, so all transports behave alike.
+
+	Subclasses based on a file descriptor only need to implement fileno(), recv()
+	and send().
+
+	"""
+	timeout = None
+
+	def fileno(self):
+		raise NotImplementedError
+
+	def recv(self, size):
+		"""Return up to 'size' bytes that are ready to be read."""
+		raise NotImplementedError
+
+	def send(self, data):
+		"""Write all of 'data'."""
+		raise NotImplementedError
+
+	def wait(self, timeout = None):
+		"""Block until there is data to read or 'timeout' seconds have passed.
+		Returns True if data is available."""
+		fd = self.fileno()
+		deadline = time.time() + timeout if timeout is not None else None
+		while True:
+			wait = max(0, deadline - time.time()) if deadline is not None else None
+			try:
+				readable = select.select([fd], [], [], wait)[0]
+			except select.error: # interrupted by a signal
+				continue
+			return bool(readable)
+
+	def inWaiting(self):
+		if not fcntl:
+			return 1 if self.wait(0) else 0 # at least one byte, recv() returns what there is
+		count = array.array('i', [0])
+		fcntl.ioctl(self.fileno(), termios.FIONREAD, count, True)
+		return count[0]
+
+	def read(self, size = 1):
+		deadline = time.time() + self.timeout if self.timeout is not None else None
+		chunks = []
+		got = 0
+		while got < size:
+			wait = max(0, deadline - time.time()) if deadline is not None else None
+			if not self.wait(wait):
+				break
+			data = self.recv(size - got)
+			if not data: # end of stream
+				break
+			chunks.append(data)
+			got += len(data)
+		return "".join(chunks)
+
+	def readinto(self, b):
+		data = self.read(len(b))
+		b[:len(data)] = data
+		return len(data)
+
+	def write(self, data):
+		self.send(data)
+		return len(data)
+
+	def flush(self):
+		pass
+
+	def flushInput(self):
+		while self.inWaiting():
+			self.recv(self.inWaiting())
+
+	def close(self):
+		pass
+
+
+class SerialTransport(serial.Serial, Transport):
+	"""pySerial backend, used for serial devices."""
+
+	def wait(self, timeout = None):
+		try:
+			fd = self.fileno()
+		except (AttributeError, ValueError, NotImplementedError):
+			fd = None
+		if fd is not None:
+			return Transport.wait(self, timeout)
+		deadline = time.time() + timeout if timeout is not None else None
+		while not self.inWaiting(): # no file descriptor to wait on (Windows), poll instead
+			if deadline is not None and time.time() >= deadline:
+				return False
+			time.sleep(0.01)
+		return True
+
+
+class TCPTransport(Transport):
+	"""Raw TCP socket backend, eg. for a serial port on a terminal server.
+
+	Arguments:
+	host	-- host name or address
+	port	-- TCP port number
+	timeout	-- read timeout, see Transport
+
+	"""
+	def __init__(self, host, port, timeout = None):
+		self.timeout = timeout
+		self.sock = socket.create_connection((host, port))
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def recv(self, size):
+		return self.sock.recv(size)
+
+	def send(self, data):
+		self.sock.sendall(data)
+
+	def close(self):
+		self.sock.close()
+
+
+class PipeTransport(Transport):
+	"""In-process backend built on a pair of OS pipes, for talking to a simulated
+	instrument (or anything else) running in the same process. Create the two
+	connected ends with PipeTransport.pair().
+
+	"""
+	def __init__(self, rfd, wfd, timeout = None):
+		self.timeout = timeout
+		self.rfd = rfd
+		self.wfd = wfd
+
+	@staticmethod
+	def pair(timeout = None):
+		"""Return two transports connected to each other."""
+		a_r, b_w = os.pipe()
+		b_r, a_w = os.pipe()
+		return PipeTransport(a_r, a_w, timeout), PipeTransport(b_r, b_w, timeout)
+
+	def fileno(self):
+		return self.rfd
+
+	def recv(self, size):
+		return os.read(self.rfd, size)
+
+	def send(self, data):
+		view = memoryview(data)
+		while len(view):
+			view = view[os.write(self.wfd, view):]
+
+	def close(self):
+		for fd in (self.rfd, self.wfd):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+
+class SessionLock(object):
+	"""Reentrant lock that lets several threads share one HPLA. Threads waiting for a
+	short operation (a single command or query) get the lock before threads starting
+	a new transaction, so quick queries slot in between the steps of long operations
+	instead of waiting for all of them.
+
+	"""
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.owner = None
+		self.depth = 0
+		self.short_waiting = 0
+
+	def acquire(self, short = False):
+		me = threading.current_thread()
+		with self.condition:
+			if self.owner is me:
+				self.depth += 1
+				return
+			if short:
+				self.short_waiting += 1
+			try:
+				while self.owner is not None or (not short and self.short_waiting):
+					self.condition.wait(1) # a timeout keeps the wait interruptible
+			finally:
+				if short:
+					self.short_waiting -= 1
+			self.owner = me
+			self.depth = 1
+
+	def release(self):
+		with self.condition:
+			if self.owner is not threading.current_thread():
+				raise RuntimeError("Releasing a session lock that isn't held")
+			self.depth -= 1
+			if not self.depth:
+				self.owner = None
+				self.condition.notify_all()
+
+
+class Reader(threading.Thread):
+	"""Background thread that keeps reading a transport into a bounded buffer, so the
+	replies are received while the controller does other things. When the buffer is
+	full the thread stops reading until there is room again, and flow control holds
+	the instrument back meanwhile.
+
+	"""
+
+	def __init__(self, port, size = 65536):
+		threading.Thread.__init__(self, name = "HPLA reader")
+		self.daemon = True
+		self.port = port
+		self.size = size
+		self.buffer = bytearray()
+		self.condition = threading.Condition()
+		self.running = True
+		self.error = None
+
+	def run(self):
+		while self.running:
+			with self.condition:
+				while self.running and len(self.buffer) >= self.size:
+					self.condition.wait(0.1)
+				room = self.size - len(self.buffer)
+			try:
+				if not self.port.wait(0.1):
+					continue
+				data = self.port.read(min(room, max(1, self.port.inWaiting())))
+			except Exception as e:
+				if self.running:
+					self.error = e
+				break
+			with self.condition:
+				self.buffer += data
+				self.condition.notify_all()
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+
+	def take(self, size, timeout = None):
+		"""Return up to 'size' received bytes, waiting up to 'timeout' seconds for the
+		first one. Raises the error that stopped the thread, if any."""
+		with self.condition:
+			if not self.buffer and self.running:
+				if timeout is None:
+					while not self.buffer and self.running:
+						self.condition.wait(1)
+				elif timeout > 0:
+					self.condition.wait(timeout)
+			if not self.buffer and self.error:
+				raise self.error
+			data = str(self.buffer[:size])
+			del self.buffer[:size]
+			self.condition.notify_all()
+			return data
+
+	def wait(self, timeout = None):
+		"""Block until there is received data or 'timeout' seconds have passed."""
+		with self.condition:
+			if not self.buffer and self.running:
+				self.condition.wait(timeout)
+			return len(self.buffer) > 0
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+		self.join()
+
+
+def frames(data):
+	"""Split received data into responses: '#' blocks and newline-terminated lines."""
+	responses = []
+	pos = 0
+	while pos < len(data):
+		if data[pos] == "#" and data[pos + 1:pos + 2].isdigit():
+			digits = int(data[pos + 1])
+			length = data[pos + 2:pos + 2 + digits]
+			end = pos + 2 + digits + (int(length) if length.isdigit() else 0)
+			end = data.find("\n", end) + 1 or len(data)
+		else:
+			end = data.find("\n", pos) + 1 or len(data)
+		responses.append(data[pos:end])
+		pos = end
+	return responses
+
+
+# Month names in the instrument's catalog dates
+MONTHS = ("JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC")
+
+# The HPLAs of a process share the cache directory, see HPLA.update_cache()
+CACHE_LOCK = threading.RLock()
+
+
+# Names associated with ID numbers are from 'HP16500B/16501A Logic Analysis System
+# Programmer's Guide' (rev. April 1994). Refer to CARDcage query documentation for details.
+MODULE_NAMES = {	1:"HP 16515A 1 GHz Timing Master Card",
+			2:"HP 16516A 1 GHz Timing Expansion Card",
+
+			11:"HP 16530A Oscilloscope Timebase Card",
+			12:"HP 16531A Oscilloscope Acquisition Card",
+			13:"HP 16532A Oscilloscope Card",
+			21:"HP 16520A Pattern Generator Master Card",
+			22:"HP 16521A Pattern Generator Expansion Card",
+			30:"HP 16511B Logic Analyzer Card",
+			31:"HP 16510A or B Logic Analyzer Card",
+			32:"HP 16550A Logic Analyzer Master Card",
+			33:"HP 16550A Logic Analyzer Expansion Card",
+			40:"HP 16540A Logic Analyzer Card",
+			41:"HP 16541A Logic Analyzer Card",
+			42:"HP 16542A Logic Analyzer Master Card",
+			43:"HP 16542A Logic Analyzer Expansion Card"}
+
+
+class Completion:
+	"""Handle for instrument operations that are still running, returned by
+	HPLA.completion(). The instrument sets the OPC bit of its Standard Event Status
+	Register when they finish, which is noticed by polling the status byte, first
+	every 'interval' seconds and then less and less often up to 'maxinterval'. The
+	OPC bit may also be read by someone else's *ESR? query (flush_errors() for
+	one), so the handle is numbered and the HPLA remembers up to which handle the
+	operations were seen complete, see HPLA.record_esr().
+
+	"""
+
+	def __init__(self, hp, number, interval = 0.05, maxinterval = 0.5):
+		self.hp = hp
+		self.number = number
+		self.interval = interval
+		self.maxinterval = maxinterval
+		self.next_poll = time.time() + interval
+		self.finished = False
+
+	def done(self):
+		"""Return True if the operations have finished. Doesn't ask the instrument
+		before the next poll is due, so it can be called as often as convenient."""
+		if self.hp.opc_done >= self.number: # seen by another *ESR? query
+			self.finished = True
+		if self.finished or time.time() < self.next_poll:
+			return self.finished
+		with self.hp.transaction(short = True):
+			stb = self.hp.comm_stb_query()
+			if type(stb) == int and stb & 32: # ESB, an enabled event bit is set
+				self.hp.comm_esr_query() # also clears the register
+				self.finished = self.hp.opc_done >= self.number
+		self.interval = min(self.interval * 2, self.maxinterval)
+		self.next_poll = time.time() + self.interval
+		return self.finished
+
+	def wait(self, timeout = 900):
+		"""Block until the operations have finished. Raises HPLATimeout if they haven't
+		in 'timeout' seconds."""
+		deadline = time.time() + timeout
+		while not self.done():
+			if time.time() >= deadline:
+				self.next_poll = 0 # one last look before giving up
+				if self.done():
+					break
+				raise HPLATimeout("Operation didn't complete in " + str(timeout) + " seconds")
+			time.sleep(max(0, min(self.next_poll, deadline) - time.time()))
+		return True
+
+
+class Identity:
+	"""What doesn't change about an instrument while connected: the *IDN? string and its
+	fields, installed software (*OPT?), the card cage layout (CARDcage?) and the 488.1
+	interface capabilities (CAPability?). 'modules' lists the installed modules as
+	(slot, module-name, master) tuples.
+
+	"""
+
+	def __init__(self, idn, options, cardcage, capability):
+		self.idn = idn
+		self.manufacturer, self.model, self.serial, self.firmware = (idn.split(",") + [""] * 4)[:4]
+		self.options = options
+		self.cardcage = cardcage
+		self.capability = capability
+		numslots = len(cardcage) / 2
+		masterlist = cardcage[numslots:]
+		self.modules = [(index + 1, MODULE_NAMES.get(int(idnum), "Unknown card " + str(idnum)), masterlist[index])
+			for index, idnum in enumerate(cardcage[0:numslots]) if int(idnum) >= 0]
+
+	def key(self):
+		"""A string identifying the instrument and its card cage layout, for caches."""
+		return self.idn + ";" + ",".join(map(str, self.cardcage))
+
+
 class HPLA:
 	"""Control HP 16500B Logic Analyzer Mainframe via RS-232"""
 	
 	# Constructor
 
-	def __init__(self, tty = "/dev/ttyUSB0", speed = 19200, timeout = None, debug = True, color = True, screenshotfile = "\HP16500.PCX", xonxoff=False, rtscts = True):
-		"""Set serial port parameters and initialize connection."""
+	def __init__(self, tty = "/dev/ttyUSB0", speed = 19200, timeout = None, debug = True, color = True, screenshotfile = "\HP16500.PCX", xonxoff=False, rtscts = True, chunksize = 256, idle = 0.1, maxmessage = 256, cachedir = os.path.join(os.path.expanduser("~"), ".ghettoib"), statecache = False, lclcheck = 1.0, reader = False):
+		"""Set serial port parameters and initialize connection. See initialize() for
+		the accepted values of 'tty'. With 'reader', replies are received by a
+		background thread (see Reader), its value can be the buffer size in bytes.
+		'maxmessage' is the longest compound message batch() will send on one line.
+		Results that are expensive to find out, like the menu map, are kept in
+		'cachedir' (None disables the cache). See remember() for 'statecache' and
+		'lclcheck'."""
 		self.tty = tty
 		self.speed = speed
 		self.timeout = timeout
 		self.debug = debug
 		self.color = color
+		if debug and not log.handlers and not logging.getLogger().handlers:
+			log.addHandler(ColorHandler())
+			log.setLevel(logging.DEBUG)
 		self.blank = False
 		self.screenshotfile = screenshotfile
 		self.xonxoff = xonxoff
 		self.rtscts = rtscts
+		self.chunksize = chunksize
+		self.idle = idle
+		self.last_transfer = None
+		self.progress_mark = 0
+		self.block_transfer = None
+		self.maxmessage = maxmessage
+		self.cachedir = cachedir
+		self.state = {} if statecache else None
+		self.lclcheck = lclcheck
+		self.lclchecked = 0
+		self.esr_seen = 0
+		self.opc_armed = 0 # number of the last Completion handle
+		self.opc_done = 0 # handles up to this one have completed
+		self.readerbuffer = 65536 if reader is True else reader
+		self.reader = None
+		self.strays = []
+		self.session = SessionLock()
+		self.batched = None
+		self.capturing = None
+		self.replies = None
 		self.initialize()
 	
-	def dbg(self, msg, color = None):
-		"""Print debug messages."""
-		c = dict(cyan = '\033[96m',
-			 magenta= '\033[95m', 
-			 blue = '\033[94m', 
-			 yellow = '\033[93m',
-			 green = '\033[92m',
-			 red = '\033[91m',
-			 end = '\033[0m')
-		source = inspect.stack()[1][3] # didn't benchmark but using inspect seemed to make startup much slower
-		if self.debug:
-			print "["+str(time.time())+"\t"+source+"]\t" + ((c[color] + msg + c['end']) if (c.has_key(color) and self.color) else msg)
+	def dbg(self, msg, color = None, *args):
+		"""Log a debug message to the "ghettoib" logger. The message is formatted with
+		'args' (msg % args) only if it is going to be shown, and nothing at all is done
+		when 'debug' is off. 'color' is used by ColorHandler."""
+		if self.debug and log.isEnabledFor(logging.DEBUG):
+			log.debug(msg, *args, extra = dict(color = color if self.color else None, source = sys._getframe(1).f_code.co_name))
 
 
 	# High-level functionality 
@@ -84,44 +562,62 @@ class HPLA:
 
 	def save_data(self, filename = None, module = None):
 		"""Save acquisition data of the current or specified module into a file."""
-		if not module:
-			module = self.main_menu_query()[0]
-		if not filename:
-			filename = "module-" + str(module) + "-data-" + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".dat"
-		self.dbg("Saving acquisition data of module " + str(module) + " into " + str(filename), "cyan")
-		self.main_select(module)
-		self.save(self.syst_data_query(), filename)
+		with self.transaction():
+			if not module:
+				module = self.main_menu_query()[0]
+			if not filename:
+				filename = "module-" + str(module) + "-data-" + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".dat"
+			self.dbg("Saving acquisition data of module %s into %s", "cyan", module, filename)
+			self.main_select(module)
+			self.save_block(filename, self.syst_data_query)
 
 	def load_data(self, filename, module = None):
 		"""Load acquisition data from a file to current or specified module."""
-		if not module:
-			module = self.main_menu_query()[0]
-		self.dbg("Loading acquisition data from file " + str(filename) + " to module " + str(module), "cyan")
-		self.main_select(module)
-		self.syst_data(self.load(filename))
+		with self.transaction():
+			if not module:
+				module = self.main_menu_query()[0]
+			self.dbg("Loading acquisition data from file %s to module %s", "cyan", filename, module)
+			self.main_select(module)
+			with open(filename, 'rb') as f:
+				self.syst_data(f)
 
 	def save_settings(self, filename = None, module = None):
 		"""Save current or specified module settings into a file."""
-		if not module:
-			module = self.main_menu_query()[0]
-		if not filename:
-			filename = "module-" + str(module) + "-settings-" + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".dat"
-		self.dbg("Saving settings data of module " + str(module) + " into " + str(filename), "cyan")
-		self.main_select(module)
-		self.save(self.syst_setup_query(), filename)
+		with self.transaction():
+			if not module:
+				module = self.main_menu_query()[0]
+			if not filename:
+				filename = "module-" + str(module) + "-settings-" + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + ".dat"
+			self.dbg("Saving settings data of module %s into %s", "cyan", module, filename)
+			self.main_select(module)
+			self.save_block(filename, self.syst_setup_query)
 			
 	def load_settings(self, filename, module = None):
 		"""Load settings into current (visible) or specified module."""
-		if not module:
-			module = self.main_menu_query()[0]
-		self.dbg("Loading settings data from file " + str(filename) + " to module " + str(module), "cyan")
-		self.main_select(module)
-		self.syst_setup(self.load(filename))
-
-	def menumap (self):
+		with self.transaction():
+			if not module:
+				module = self.main_menu_query()[0]
+			self.dbg("Loading settings data from file %s to module %s", "cyan", filename, module)
+			self.main_select(module)
+			with open(filename, 'rb') as f:
+				self.syst_setup(f)
+			self.invalidate()
+
+	def menumap (self, refresh = False):
 		"""Map the available menus on the instrument. Iterate through reasonable
 		numbers and save all the menus that didn't give the error (-211, "Legal comman").
 
+		Only the system, the software options and the modules 'installed_modules' finds
+		in the card cage are probed. Each probe is a ':MENU m,n;:SYST:ERR?' pair and as
+		many pairs as fit in 'maxmessage' are sent in one message. The result is saved in
+		'cachedir' under the instrument's identification and card cage layout, so later
+		calls return it without probing until the hardware changes, unless the replies
+		didn't line up with the probes. The menu shown before probing is restored
+		afterwards.
+
+		Arguments:
+		refresh	-- boolean: probe even if there is a cached map
+
 		Returns:
 		A list of tuples: [ (module_index, [menu1, menu2, ...]), (module_index,[menu1, ... ]) ]
 
@@ -129,49 +625,228 @@ class HPLA:
 		[(0, [0, 1, 2, 3, 4, 5]), (3, [0, 1, 2, 3, 4, 5]), (4, [0, 1, 2, 3, 4, 5]), (5, [0, 1, 3, 5, 7, 9])]
 
 		"""
-		self.serialport.timeout = 5
-		self.flush_errors()
+		key = self.identity().key()
+		cache = self.load_cache("menumap.json")
+		if key in cache and not refresh:
+			self.dbg("Using cached menu map.", "green")
+			return [(module, menus) for module, menus in cache[key]]
+		self.flush_errors(esr = False) # a stale error would be taken for the first probe's
 		beeper = self.main_beeper_query()
+		current = self.main_menu_query()
 		self.main_beeper(0)
+		modules = [-2, -1, 0] + sorted(set(master for slot, name, master in self.installed_modules()))
+		self.dbg("Searching for available menus of modules %s...", "cyan", modules)
+		probes = [(module, menu) for module in modules for menu in range(16)] # should be enough?
+		found = []
+		aligned = True
+		while probes:
+			line = []
+			while len(line) < len(probes) and (not line or len(";".join(line)) + 23 < self.maxmessage): # room for one more pair
+				line.append(":MENU %d,%d;:SYST:ERR?" % probes[len(line)])
+			errors = self.split_reply(self.query(";".join(line), timeout = 5))
+			if len(errors) != len(line):
+				aligned = False
+			for (module, menu), err in zip(probes, errors):
+				if err.strip() == "0":
+					self.dbg("Found menu %s,%s", "green", module, menu)
+					found.append((module, menu))
+			probes = probes[len(line):]
+		if self.flush_errors(esr = False): # the error of the last probe was left over
+			aligned = False
+		if type(current) == tuple and current[0] in modules and current[1] < 16 and current not in found: # the menu shown exists for sure
+			aligned = False
 		available_menus = []
-		self.dbg("Searching for available menus...", "cyan")
-		for module in range(-2,11): # -2 to 10
-			module_menus = []
-			for menu in range(16): # should be enough?
-				self.main_menu(module, menu)
-				self.comm_opc_query()
-				err = self.syst_error_query()
-				if err[0] == 0:
-					self.dbg("Found menu " + str(module) + "," + str(menu), "green")
-					module_menus += [menu]
-				time.sleep(0.1)
+		for module in modules:
+			module_menus = [menu for m, menu in found if m == module]
 			if module_menus:
 				available_menus += [(module, module_menus)]
-		time.sleep(0.5)
-		self.main_beeper(beeper)
-		self.serialport.timeout = self.timeout
+		self.invalidate(":MENU?", ":SELECT?")
+		with self.batch():
+			if type(current) == tuple:
+				self.main_menu(*current)
+			self.main_beeper(beeper)
+		if not aligned:
+			self.dbg("The replies didn't line up with the probes, not caching the menu map.", "red")
+			return available_menus
+		with self.update_cache("menumap.json") as cache:
+			cache[key] = available_menus
 		return available_menus
 
+	def load_cache(self, name):
+		"""Read a JSON file from the cache directory, returns an empty dictionary if
+		there isn't one."""
+		if not self.cachedir:
+			return {}
+		try:
+			with open(os.path.join(self.cachedir, name)) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return {}
+
+	def save_cache(self, name, data):
+		"""Write a JSON file into the cache directory."""
+		if not self.cachedir:
+			return
+		try:
+			if not os.path.isdir(self.cachedir):
+				os.makedirs(self.cachedir)
+			fd, temp = tempfile.mkstemp(prefix = name + ".", dir = self.cachedir)
+			try:
+				with os.fdopen(fd, "w") as f:
+					json.dump(data, f)
+				os.rename(temp, os.path.join(self.cachedir, name)) # don't leave a half-written cache behind
+			except:
+				os.remove(temp)
+				raise
+		except (IOError, OSError) as e:
+			self.dbg("Couldn't save cache: %s", "yellow", e)
+
+	@contextlib.contextmanager
+	def update_cache(self, name):
+		"""Read a JSON file from the cache directory for modifying, and write it back
+		at the end of the 'with' block. Other HPLAs (in this process, and in other
+		processes where file locks are available) wait meanwhile, so that their
+		updates aren't lost.
+
+		Example:
+		with self.update_cache("files.json") as index:
+			index[location] = version
+
+		"""
+		with CACHE_LOCK:
+			lock = None
+			try:
+				if self.cachedir and fcntl:
+					if not os.path.isdir(self.cachedir):
+						os.makedirs(self.cachedir)
+					lock = open(os.path.join(self.cachedir, name + ".lock"), "a")
+					fcntl.flock(lock, fcntl.LOCK_EX)
+			except (IOError, OSError) as e:
+				self.dbg("Couldn't lock cache: %s", "yellow", e)
+			try:
+				data = self.load_cache(name)
+				yield data
+				self.save_cache(name, data)
+			finally:
+				if lock:
+					lock.close() # releases the lock
+
+	def remember(self, key, value):
+		"""Record a value in the state cache. Returns the value.
+
+		With the constructor argument statecache = True, the values set with main_select,
+		main_menu, main_beeper, main_setcolor, syst_header, syst_longform and the replies
+		to their queries (and mmem_msi_query) are kept, keyed by the query command. The
+		queries are then answered without asking the instrument and setters that wouldn't
+		change anything aren't sent. The cache is cleared by invalidate(), *RST, loading
+		settings or configurations, when flush_errors() finds errors (a setter may have
+		been rejected) and when the LOCAL key has been pressed, which is checked with
+		':LER?' before using the cache if 'lclcheck' seconds have passed since the last
+		check. Commands sent with cmd() or query() directly aren't tracked, call
+		invalidate() after changing these settings that way.
+
+		"""
+		if self.state is not None and value is not None and value != "":
+			self.state[key] = value
+		return value
+
+	def cached(self, key):
+		"""Return the value of 'key' in the state cache, or None if it isn't known."""
+		if not self.state or key not in self.state or self.capturing is not None or self.replies is not None:
+			return None
+		if time.time() - self.lclchecked > self.lclcheck:
+			ler = self.main_ler_query()
+			self.lclchecked = time.time()
+			if ler != 0:
+				self.dbg("Front panel used, forgetting instrument state.", "yellow")
+				self.invalidate()
+				return None
+		self.dbg("Cached %s %s", "blue", key, self.state[key])
+		return self.state[key]
+
+	def invalidate(self, *keys):
+		"""Forget the given keys (query commands) or everything from the state cache."""
+		if self.state is None:
+			return
+		if not keys:
+			self.state.clear()
+		for key in keys:
+			self.state.pop(key, None)
+
+	def unchanged(self, key, value):
+		"""Return True if the state cache knows that the setting queried with 'key' is
+		already 'value', so a setter doesn't need to send it. Never True for None or
+		when the cache is off."""
+		return self.state is not None and value is not None and self.cached(key) == value
+
+	def onoff(self, setting):
+		"""Normalize a 1/"1"/"ON" or 0/"0"/"OFF" setting into 1 or 0 (None if neither)."""
+		return {"1": 1, "ON": 1, "0": 0, "OFF": 0}.get(str(setting).upper())
+
 	def screenshot_menus(self, image_basename, menumap):
-		"""Screenshot all menus in the menumap list."""
+		"""Screenshot all menus in the menumap list. The previous screenshot is
+		converted and saved while the instrument prints the next one."""
 		current = self.mmem_msi_query()
+		previous = None
 		for module_menus in menumap:
 			module, menulist = module_menus
 			for menu in menulist:
 				floppy = module == 0 and menu == 2
-				self.dbg("Screenshotting menu " + str(module) + "," + str(menu), "cyan")
-				self.main_menu(module, menu)
-				self.comm_opc_query()
-				self.screenshot(image_basename + "_" + str(module) + "-" + str(menu) + ".png", msus=("INT1" if floppy else current))
-				self.comm_opc_query()
+				msus = "INT1" if floppy else current
+				self.dbg("Screenshotting menu %s,%s", "cyan", module, menu)
+				with self.transaction():
+					self.main_menu(module, menu)
+					self.comm_opc_query()
+					printing = self.syst_print("SCREEN", self.screenshotfile, msus = msus, wait = False)
+				if previous:
+					self.save_png(*previous)
+				printing.wait()
+				previous = (self.fetch_screenshot(self.screenshotfile, msus), image_basename + "_" + str(module) + "-" + str(menu) + ".png")
 				time.sleep(1)
+		if previous:
+			self.save_png(*previous)
 		return menumap
+
+	def completion(self):
+		"""Arm the instrument to report when the operations sent so far have finished and
+		return a Completion handle for them, instead of blocking on comm_opc_query().
+		Enables the OPC bit in the Standard Event Status Enable Register if needed (once
+		per connection) and clears the event register before sending *OPC.
+
+		Example:
+		hp.mmem_store("SETUP", "saved setup")
+		done = hp.completion()
+		... do something else ...
+		done.wait()
+
+		"""
+		with self.transaction():
+			if not self.opc_enabled:
+				ese = self.comm_ese_query()
+				if type(ese) != int or not ese & 1:
+					self.comm_ese((ese or 0) | 1)
+				self.opc_enabled = True
+			self.record_esr(self.query_num("*ESR?;*OPC")) # clear a stale OPC bit and arm it again
+			self.opc_armed += 1
+			return Completion(self, self.opc_armed)
+
+	def record_esr(self, esr):
+		"""Remember what was read from the Standard Event Status Register, as reading it
+		clears the register: the error bits for flush_errors() and the OPC bit for the
+		Completion handles armed before the read. Returns 'esr'."""
+		if type(esr) == int:
+			self.esr_seen |= esr & ~1
+			if esr & 1:
+				self.opc_done = self.opc_armed
+		return esr
+
 				
 	def dimscreen (self):
-		"""Set all colors black, one by one."""
+		"""Set all colors black in one compound message."""
 		self.dbg("Dimming screen...", "cyan")
-		for c in range(1,8):
-			self.main_setcolor(c, 0, 0, 0)
+		with self.batch():
+			for c in range(1,8):
+				self.main_setcolor(c, 0, 0, 0)
 	
 	def togglescreen(self):
 		"""Toggle between black and default colors."""
@@ -185,6 +860,18 @@ class HPLA:
 			self.dbg("Resetting screen colors...", "cyan")
 			self.main_setcolor_default()
 
+	def status(self):
+		"""Take a snapshot of the instrument state with one pipelined message.
+
+		Returns:
+		A dictionary of the identification, current menu and selected module, status byte,
+		combined event status register and the intermodule tree
+
+		"""
+		keys = ("idn", "menu", "select", "stb", "cesr", "tree")
+		return dict(zip(keys, self.pipeline(self.comm_idn_query, self.main_menu_query, self.main_select_query,
+			self.comm_stb_query, self.main_cesr_query, self.inter_tree_query)))
+
 	def synctime (self):
 		"""Sets instrument RTC to current date and time."""
 		self.dbg("Synchronizing instrument RTC with current time...", "cyan")
@@ -192,209 +879,985 @@ class HPLA:
 	
 	def installed_modules(self):
 		"""Returns a list of (slot, module-name, master) tuples of each installed module.
-		modulelist is the result list of the module query (":CARDCAGE?").
-		Names associated with ID numbers are from 'HP16500B/16501A Logic Analysis System 
-		Programmer's Guide' (rev. April 1994). Refer to CARDcage query documentation for details.
-
-		"""
-		self.dbg("Querying installed modules...", "cyan")
-		modulelist = self.main_cardcage_query()
-		numslots = len(modulelist)/2
-		slots = []
-		idnumbers = {	1:"HP 16515A 1 GHz Timing Master Card",
-				2:"HP 16516A 1 GHz Timing Expansion Card",
-
-				11:"HP 16530A Oscilloscope Timebase Card",
-				12:"HP 16531A Oscilloscope Acquisition Card",
-				13:"HP 16532A Oscilloscope Card",
-				21:"HP 16520A Pattern Generator Master Card",
-				22:"HP 16521A Pattern Generator Expansion Card",
-				30:"HP 16511B Logic Analyzer Card",
-				31:"HP 16510A or B Logic Analyzer Card",
-				32:"HP 16550A Logic Analyzer Master Card",
-				33:"HP 16550A Logic Analyzer Expansion Card",
-				40:"HP 16540A Logic Analyzer Card",
-				41:"HP 16541A Logic Analyzer Card",
-				42:"HP 16542A Logic Analyzer Master Card",
-				43:"HP 16542A Logic Analyzer Expansion Card"}
-		masterlist = modulelist[numslots:]
-		for index, idnum in enumerate(modulelist[0:numslots]):
-			if int(idnum) >= 0:
-				slots.append((index + 1, idnumbers[int(idnum)], masterlist[index]))
-		return slots
-	
+		The list comes from the instrument's identity(), so the card cage is only queried
+		once per connection.
+
+		"""
+		return list(self.identity().modules)
+
+	def identity(self, refresh = False):
+		"""Return the Identity (*IDN?, *OPT?, CARDcage? and CAPability?) of the connected
+		instrument. These don't change while connected, so they're queried once, in one
+		pipelined message, and reused until reconnecting or inserting or deleting
+		intermodule modules.
+
+		Arguments:
+		refresh	-- boolean: query again even if already known
+
+		"""
+		with self.transaction():
+			if self.ident is None or refresh:
+				self.dbg("Identifying instrument...", "cyan")
+				self.ident = Identity(*self.pipeline(self.comm_idn_query, self.comm_opt_query,
+					self.main_cardcage_query, self.main_capability_query))
+			return self.ident
+
 	def screenshot(self, filename, printfile = None, msus = "INT0", download = True):
 		"""Capture color screenshot and save as PNG.
 		First saves the screenshot in PCX format to the instrument's internal
 		hard disk, then uploads the image data to be written into a PNG file.
 		
 		"""
-		if not printfile:
-			printfile = self.screenshotfile
-		self.dbg("Capturing screen shot as " + printfile, "cyan")
-		self.syst_print("SCREEN", printfile, msus = msus)
-		self.dbg("Waiting for disk operation to finish...", "cyan")
-		self.comm_opc_query()
-		if download:
-			self.dbg("Transferring screen shot...", "cyan")
-			imagedata = cStringIO.StringIO(self.mmem_upload_query(printfile, msus = msus))
-			im = Image.open(imagedata)
-			self.dbg("Saving screen shot as " + filename, "cyan")
-			im.save(filename, "PNG")
+		with self.transaction():
+			if not printfile:
+				printfile = self.screenshotfile
+			self.dbg("Capturing screen shot as %s", "cyan", printfile)
+			self.syst_print("SCREEN", printfile, msus = msus)
+			if download:
+				self.save_png(self.fetch_screenshot(printfile, msus), filename)
+
+	def fetch_screenshot(self, printfile, msus = "INT0"):
+		"""Transfer a printed screen shot into memory, returns a file-like object."""
+		self.dbg("Transferring screen shot...", "cyan")
+		imagedata = cStringIO.StringIO()
+		self.mmem_upload_query(printfile, msus = msus, dest = imagedata)
+		imagedata.seek(0)
+		return imagedata
+
+	def save_png(self, imagedata, filename):
+		"""Convert image data from the instrument into a PNG file."""
+		im = Image.open(imagedata)
+		self.dbg("Saving screen shot as %s", "cyan", filename)
+		im.save(filename, "PNG")
 			
-	def flush_errors(self):
-		"""Return a list of all errors in the instrument's error queue."""
-		self.dbg("Flushing error queue...", "cyan")
-		errors = []
-		while 1:
-			e = self.syst_error_query()
-			if type(e) != tuple:
-				break;
-			if e[0] == 0: # 0 = 'No errors'
-				break;
-			errors += [e]
-		return errors
+	def flush_errors(self, esr = True, depth = 8):
+		"""Return a list of all errors in the instrument's error queue.
+
+		The queue is read 'depth' entries at a time with one pipelined query, until
+		the first 0,"No error" entry. With 'esr' the Standard Event Status Register is
+		read first and if none of its error bits (CME, EXE, DDE, QYE) are set the
+		queue isn't read at all. Reading *ESR? clears the register, so use esr = False
+		if something else may have read it since the errors were queued.
 
+		Arguments:
+		esr	-- boolean: check *ESR? before reading the queue
+		depth	-- integer: number of queue entries requested per message
+
+		"""
+		with self.transaction():
+			self.dbg("Flushing error queue...", "cyan")
+			if esr:
+				status = self.comm_esr_query()
+				if type(status) == int:
+					status |= self.esr_seen # error bits read earlier, by Completion for one
+				self.esr_seen = 0
+				if type(status) == int and not status & 0x3C:
+					self.dbg("No error bits in ESR.", "cyan")
+					return []
+			errors = []
+			while 1:
+				for e in self.pipeline(*[self.syst_error_query] * depth):
+					if type(e) != tuple or e[0] == 0: # 0 = 'No errors'
+						if errors:
+							self.invalidate()
+						return errors
+					errors += [e]
 
 	# File methods
 
-	def readblock (self, timeout = 0.5): # adjust timeout?
+	def readblock (self, timeout = 0.5, dest = None): # adjust timeout?
 		"""Read definite-length block data from instrument.
 		Response is in the form '#<number of digits in block length><block length><data>',
 		for example "#800000075<75 bytes of data>", where '#8' means the next 8 digits represent
 		the length of the block, ie. 00000075 = 75 bytes.
+
+		If 'dest' is given, the block is streamed into it chunk by chunk instead of being
+		returned as a string. It can be a file-like object or a writable buffer (eg. a
+		bytearray) large enough for the block. The timeout applies to each chunk, so a
+		transfer can take as long as it needs as long as data keeps coming. HPLATimeout is
+		raised if the block ends short of the length given in its header.
+
+		Returns:
+		The block data as a string, or the number of bytes received if 'dest' is given
+
 		"""
-		self.serialport.timeout=timeout
-		blockpound = self.serialport.read(1) # read block header
-		data = ""
-		if blockpound == '#':
-			numdigits = int(self.serialport.read())
-			numdata = int(self.serialport.read(numdigits))
-			self.dbg("Receiving block of " + str(numdata) + " bytes", "cyan")
-			data = self.serialport.read(numdata)
-			self.dbg("Received " + str(len(data)) + " bytes.", "cyan")
-		self.serialport.timeout=self.timeout
-		if not data:
-			self.dbg("Didn't receive anything.", "yellow")
-		self.serialport.flushInput() # for eating extra newlines and such (upload_query...)
-		return data
+		with self.transaction():
+			blockpound = self.read(1, timeout) # read block header
+			data = ""
+			numdata = received = 0
+			if blockpound == '#':
+				numdigits = int(self.read(1, timeout))
+				numdata = int(self.read(numdigits, timeout))
+				self.dbg("Receiving block of %d bytes", "cyan", numdata)
+				self.block_transfer = (numdata, time.time())
+				try:
+					if dest is None:
+						data = self.read(numdata, timeout)
+						received = len(data)
+					else:
+						received = self.stream(dest, numdata, timeout)
+				finally:
+					self.block_transfer = None
+				self.dbg("Received %d bytes.", "cyan", received)
+				# the block is followed by the response message terminator
+				self.read(1, self.idle)
+			if not received:
+				self.dbg("Didn't receive anything.", "yellow")
+			self.discard_input() # for eating extra newlines and such (upload_query...)
+			if dest is None:
+				return data
+			if blockpound != '#':
+				raise HPLATimeout("Expected a block but got " + (repr(blockpound) if blockpound else "nothing"))
+			if received < numdata:
+				raise HPLATimeout("Block transfer stalled after " + str(received) + " of " + str(numdata) + " bytes")
+			return received
+
+	def save_block(self, filename, query, *args, **kwargs):
+		"""Stream the block returned by a query method, eg. syst_data_query, into a file.
+		If the block doesn't arrive in full the file is removed and the error raised."""
+		try:
+			with open(filename, 'wb') as f:
+				return query(*args, dest = f, **kwargs)
+		except Exception:
+			if os.path.exists(filename):
+				os.remove(filename)
+			raise
+
+	def stream(self, dest, size, timeout = None, chunksize = 4096, progress = None):
+		"""Copy 'size' bytes from the instrument into 'dest' without holding the whole
+		transfer in memory. Chunks are read into a preallocated buffer and written out
+		as they arrive. Stops early if 'timeout' seconds pass without new data.
+
+		Arguments:
+		dest		-- file-like object or a writable buffer of at least 'size' bytes
+		size		-- number of bytes to transfer
+		timeout		-- seconds to wait for each chunk
+		chunksize	-- size of the read buffer
+		progress	-- (optional) callback progress(received, total), see send
+
+		Returns:
+		Number of bytes received
+
+		"""
+		if hasattr(dest, "write"):
+			put = lambda offset, chunk: dest.write(chunk)
+		else:
+			target = memoryview(dest)
+			if len(target) < size:
+				raise ValueError("Buffer of " + str(len(target)) + " bytes is too small for " + str(size) + " bytes")
+			def put(offset, chunk):
+				target[offset:offset + len(chunk)] = chunk
+		if not progress:
+			progress = self.progress
+		start = time.time()
+		head = self.rxbuf[:size]
+		self.rxbuf = self.rxbuf[size:]
+		put(0, head)
+		got = len(head)
+		view = memoryview(bytearray(chunksize))
+		while got < size:
+			if self.reader:
+				chunk = self.pull(min(chunksize, size - got), timeout)
+				n = len(chunk)
+			else:
+				self.settimeout(timeout)
+				n = self.serialport.readinto(view[:min(chunksize, size - got, max(1, self.serialport.inWaiting()))])
+				chunk = view[:n]
+			if not n:
+				self.dbg("No data for %s seconds, got %d of %d bytes", "red", timeout, got, size)
+				break
+			put(got, chunk)
+			got += n
+			progress(got, size)
+		self.transfer_stats(got, time.time() - start)
+		return got
 	
 	def save(self, data, filename):
 		"""Saves data into a file."""
 		with open(filename, 'wb') as f:
-			self.dbg("Writing " + str(len(data)) + " bytes to file " + filename, "cyan")
+			self.dbg("Writing %d bytes to file %s", "cyan", len(data), filename)
 			f.write(data)
 
 	def load(self, filename):
 		"""Returns contents of a file."""
 		with open(filename, 'rb') as f:
-			self.dbg("Opened file " + filename, "cyan")
+			self.dbg("Opened file %s", "cyan", filename)
 			return f.read()
 	
-	def put(self, filename, remotename, desc = "from ghettoIB", type = -5813, msus="INT0"):            
+	def put(self, filename, remotename, desc = "from ghettoIB", type = -5813, msus="INT0", wait = True):
 		"""Transfer a file from the controller to the instrument. By default the file
-		type is DOS (-5813) and the file is saved on the hard disk."""
-	        self.dbg("Sending file " + str(filename) + " to file " + str(remotename) + ", description: '" + str(desc) + "', type " + str(type) + ", msus: " + str(msus), "cyan")
-		self.mmem_download(remotename, desc, type, self.load(filename), msus = msus)
-		self.comm_opc_query()
+		type is DOS (-5813) and the file is saved on the hard disk. With wait = False
+		returns a Completion handle instead of waiting for the disk write."""
+		with self.transaction():
+		        self.dbg("Sending file %s to file %s, description: '%s', type %s, msus: %s", "cyan", filename, remotename, desc, type, msus)
+			with open(filename, 'rb') as f:
+				self.mmem_download(remotename, desc, type, f, msus = msus)
+			if not wait:
+				return self.completion()
+			self.comm_opc_query()
 		
-	def get(self, filename, remotename, msus = "INT0"):
+	def get(self, filename, remotename, msus = "INT0", cache = True):
 		"""Transfer a file from the instrument to the controller, by default from the
-		hard disk."""
-	        self.dbg("Downloading file " + str(remotename) + " to file " + str(filename) + " from msus: " + str(msus), "cyan")
-	        self.save(self.mmem_upload_query(remotename, msus = msus), filename)
-		self.comm_opc_query()
+		hard disk. If 'cache' is True and there is a 'cachedir', a copy of the file is
+		kept there and later gets are served from it for as long as the catalog entry
+		(type, description and date/time) of the file stays the same, which costs a
+		catalog and a PWD query instead of the transfer. Only files in the current
+		directory of the drive are cached, names with a path are always transferred."""
+		with self.transaction():
+		        self.dbg("Downloading file %s to file %s from msus: %s", "cyan", remotename, filename, msus)
+			key = self.file_key(remotename, msus) if cache and self.cachedir else None
+			cached = os.path.join(self.cachedir, "files", key[1]) if key else None
+			if cached and os.path.exists(cached):
+				self.dbg("File hasn't changed, copying it from the cache.", "green")
+				shutil.copyfile(cached, filename)
+				return
+			self.save_block(filename, self.mmem_upload_query, remotename, msus = msus)
+			self.comm_opc_query()
+			if cached:
+				self.cache_file(key, filename)
+
+	def file_key(self, remotename, msus = None):
+		"""Identify the current version of a file on the instrument for the download cache.
+
+		Returns:
+		Tuple (location, version) of strings, or None if the file can't be cached
+
+		"""
+		with self.transaction():
+			if "\\" in remotename or "/" in remotename:
+				return None
+			for entry in self.mmem_catalog_query(all = True, msus = msus):
+				name, filetype, description, stamp = entry
+				if name.strip().upper() == remotename.upper():
+					directory, drive = (self.mmem_pwd_query(msus) + ("", ""))[:2]
+					# several analyzers can share the cache directory
+					location = self.identity().idn + ";" + drive + ":" + directory.strip('"').rstrip("\\") + "\\" + name.strip()
+					version = "\0".join([location, str(filetype), description.strip(), stamp])
+					return location, hashlib.sha1(version).hexdigest()
+			return None
+
+	def cache_file(self, key, filename):
+		"""Store a downloaded file in the download cache, replacing its older version."""
+		location, version = key
+		try:
+			directory = os.path.join(self.cachedir, "files")
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			shutil.copyfile(filename, os.path.join(directory, version))
+		except (IOError, OSError) as e:
+			self.dbg("Couldn't cache file: %s", "yellow", e)
+			return
+		with self.update_cache("files.json") as index:
+			old = index.get(location)
+			if old and old != version and os.path.exists(os.path.join(directory, old)):
+				os.remove(os.path.join(directory, old))
+			index[location] = version
+
+	def sync(self, localdir, remotedir = "\\", msus = "INT0", upload = False, purge = False, dryrun = False):
+		"""Synchronize a directory tree between the controller and the instrument's disk,
+		rsync style. By default files are copied from 'remotedir' on the instrument into
+		'localdir', with upload = True the other way around. Directories are walked
+		recursively and created where missing, and only new or changed files are sent:
+
+		- downloaded files get the date and time of their catalog entry, so a file is
+		  downloaded again when the instrument's timestamp differs from the local one
+		- the instrument stamps uploaded files itself, so the size and modification time
+		  of each uploaded file are recorded in 'cachedir' (sync.json) with the catalog
+		  timestamp it got, and the file is uploaded again if either side changes
+
+		With 'purge', directories that don't exist on the source side are removed too,
+		after the files in them. The catalog doesn't tell file sizes, so the transfer
+		time of a dry run can only be estimated for uploads and for downloads of files
+		that exist locally. The destination directory is created if it doesn't exist.
+		The error queue is checked after each action on the instrument and if some of
+		them failed, IOError is raised after the rest of the plan has been carried out;
+		the failed uploads aren't recorded in sync.json.
+
+		Arguments:
+		localdir	-- string: directory on the controller
+		remotedir	-- string: absolute directory on the instrument
+		msus		-- string: Mass Storage Unit Specifier of the instrument's drive
+		upload		-- boolean: copy from the controller to the instrument
+		purge		-- boolean: also delete files that don't exist on the source side
+		dryrun		-- boolean: only print the plan and the estimated transfer time
+
+		Returns:
+		The plan as a list of (action, path, size) tuples. Action is "mkdir", "get", "put"
+		or "purge", path is relative to the synchronized directories and size is the
+		number of bytes to transfer (None if not known).
+
+		"""
+		pwd = self.mmem_pwd_query(msus)
+		try:
+			try:
+				rfiles, rdirs = self.remote_tree(remotedir, msus)
+				missing = False
+			except IOError:
+				if not upload:
+					raise
+				rfiles, rdirs = {}, [] # created before uploading
+				missing = True
+			lfiles, ldirs = self.local_tree(localdir)
+			# the instrument's names are case-insensitive, compare in upper case
+			rfiles = dict((path.upper(), entry) for path, entry in rfiles.items())
+			rdirs = [d.upper() for d in rdirs]
+			spelling = dict((path.upper(), path) for path in list(lfiles) + ldirs)
+			def spell(path):
+				"""Local name of a remote path, keeping the case of the existing local names."""
+				if path in spelling:
+					return spelling[path]
+				head, sep, name = path.rpartition("\\")
+				return (spell(head) if head else "") + sep + name
+			record = self.load_cache("sync.json")
+			location = lambda path: self.identity().idn + ";" + str(msus).upper() + ":" + self.remotepath(remotedir, path)
+			plan = []
+			if upload:
+				plan += [("mkdir", d, None) for d in ldirs if d.upper() not in rdirs]
+				for path, (size, mtime) in sorted(lfiles.items()):
+					entry = rfiles.get(path.upper())
+					if entry is None or record.get(location(path.upper())) != [size, mtime, entry[2]]:
+						plan.append(("put", path, size))
+				if purge:
+					uploaded = set(path.upper() for path in list(lfiles) + ldirs)
+					plan += [("purge", path, None) for path in sorted(rfiles) if path not in uploaded]
+					plan += [("purge", d, None) for d in sorted(rdirs, reverse = True) if d not in uploaded] # subdirectories first
+			else:
+				plan += [("mkdir", spell(d), None) for d in rdirs if d not in spelling]
+				for path, (filetype, description, stamp) in sorted(rfiles.items()):
+					local = lfiles.get(spell(path))
+					if local is None or local[1] != self.catalog_time(stamp):
+						plan.append(("get", spell(path), local[0] if local else None))
+				if purge:
+					plan += [("purge", path, None) for path in sorted(lfiles) if path.upper() not in rfiles]
+					plan += [("purge", d, None) for d in sorted(ldirs, reverse = True) if d.upper() not in rdirs]
+			if dryrun:
+				self.print_plan(plan)
+				return plan
+			if missing:
+				parts = remotedir.replace("/", "\\").strip("\\").upper().split("\\")
+				for i in range(len(parts)):
+					if not self.remote_cd("\\" + "\\".join(parts[:i + 1]), msus):
+						self.mmem_mkdir("\\" + "\\".join(parts[:i + 1]), msus)
+			elif not upload and not os.path.isdir(localdir):
+				os.makedirs(localdir)
+			failed = {}
+			for action, path, size in plan:
+				self.dbg("%s %s", "cyan", action, path)
+				remote = self.remotepath(remotedir, path)
+				local = os.path.join(localdir, *path.split("\\"))
+				if action == "mkdir":
+					if upload:
+						self.mmem_mkdir(remote.upper(), msus)
+					elif not os.path.isdir(local):
+						os.makedirs(local)
+				elif action == "get":
+					if not os.path.isdir(os.path.dirname(local)):
+						os.makedirs(os.path.dirname(local))
+					self.save_block(local, self.mmem_upload_query, remote, msus = msus)
+					self.comm_opc_query()
+					stamp = self.catalog_time(rfiles[path.upper()][2])
+					os.utime(local, (stamp, stamp))
+				elif action == "put":
+					filetype, description = rfiles.get(path.upper(), (-5813, "from ghettoIB", None))[:2]
+					with open(local, "rb") as f:
+						self.mmem_download(remote.upper(), description.strip(), filetype, f, msus = msus)
+					self.comm_opc_query()
+				elif action == "purge":
+					if upload:
+						self.mmem_purge(remote, msus) # directories are empty by now
+					elif os.path.isdir(local):
+						os.rmdir(local)
+					else:
+						os.remove(local)
+				if upload or action == "get":
+					errors = self.flush_errors()
+					if errors:
+						self.dbg("%s %s failed: %s", "red", action, path, errors)
+						failed[path.upper()] = errors
+			if upload and plan:
+				rfiles = self.remote_tree(remotedir, msus)[0] # the new timestamps
+				with self.update_cache("sync.json") as record:
+					for path, (size, mtime) in lfiles.items():
+						if path.upper() in rfiles and path.upper() not in failed:
+							record[location(path.upper())] = [size, mtime, rfiles[path.upper()][2]]
+			if failed:
+				raise IOError("Failed to sync " + "; ".join(path + " " + str(errors) for path, errors in sorted(failed.items())))
+			return plan
+		finally:
+			if pwd and pwd[0]:
+				self.mmem_cd(pwd[0].strip('"'), msus)
+
+	def remotepath(self, remotedir, path):
+		"""Join a relative path to an absolute directory on the instrument."""
+		return (remotedir.rstrip("\\") + "\\" + path).rstrip("\\") or "\\"
+
+	def remote_tree(self, remotedir, msus = None):
+		"""List a directory tree on the instrument, one catalog query per directory.
+
+		Returns:
+		Tuple (files, dirs): a dictionary mapping relative paths of the files to their
+		(type, description, date and time) and a sorted list of relative directory paths
+
+		Raises IOError if 'remotedir' doesn't exist.
+
+		"""
+		files = {}
+		dirs = []
+		pending = [""]
+		while pending:
+			directory = pending.pop(0)
+			with self.transaction():
+				if not self.remote_cd(self.remotepath(remotedir, directory), msus):
+					raise IOError("No directory " + self.remotepath(remotedir, directory) + " on the instrument")
+				listing = self.mmem_catalog_query(all = True, msus = msus)
+			for name, filetype, description, stamp in listing:
+				name = name.strip()
+				if name in (".", ".."):
+					continue
+				path = directory + "\\" + name if directory else name
+				if type(filetype) != int: # directories aren't numeric
+					dirs.append(path)
+					pending.append(path)
+				else:
+					files[path] = (filetype, description, stamp)
+		return files, sorted(dirs)
+
+	def remote_cd(self, remotedir, msus = None):
+		"""Change the current directory on the instrument and check that it changed, as
+		the CD command just queues an error if the directory doesn't exist.
+
+		Returns:
+		True if 'remotedir' is now the current directory, otherwise the error of the CD
+		is flushed and False returned
+
+		"""
+		with self.transaction():
+			self.mmem_cd(remotedir, msus)
+			pwd = self.mmem_pwd_query(msus)
+			if pwd[0].strip('"').upper() == remotedir.replace("/", "\\").upper():
+				return True
+			self.flush_errors(esr = False)
+			return False
+
+	def local_tree(self, localdir):
+		"""List a directory tree on the controller with the paths in instrument form.
+
+		Returns:
+		Tuple (files, dirs): a dictionary mapping relative paths of the files to their
+		(size, modification time in whole seconds) and a sorted list of relative
+		directory paths
+
+		"""
+		files = {}
+		dirs = []
+		for root, subdirs, names in os.walk(localdir):
+			relative = os.path.relpath(root, localdir)
+			prefix = "" if relative == os.curdir else relative.replace(os.sep, "\\") + "\\"
+			dirs += [prefix + d for d in subdirs]
+			for name in names:
+				st = os.stat(os.path.join(root, name))
+				files[prefix + name] = (st.st_size, int(st.st_mtime))
+		return files, sorted(dirs)
+
+	def catalog_time(self, stamp):
+		"""Turn a "DDMMMYY HH:MM:SS" catalog timestamp into seconds since the epoch. The
+		month names are always English, so they aren't parsed with the locale's %b."""
+		date, clock = stamp.strip().split()
+		day, month, year = int(date[:2]), MONTHS.index(date[2:5].upper()) + 1, int(date[5:])
+		hour, minute, second = map(int, clock.split(":"))
+		return int(time.mktime((2000 + year if year < 70 else 1900 + year, month, day, hour, minute, second, 0, 0, -1)))
+
+	def print_plan(self, plan):
+		"""Print a sync plan and how long its transfers would take at the current speed."""
+		known = sum(size for action, path, size in plan if size is not None and action in ("get", "put"))
+		unknown = len([a for a, path, size in plan if size is None and a in ("get", "put")])
+		for action, path, size in plan:
+			print "%-6s %s%s" % (action, path, "" if size is None else " (" + str(size) + " bytes)")
+		print str(len(plan)) + " actions, " + str(known) + " bytes to transfer, about " + \
+			str(int(round(known / self.linerate()))) + " seconds at " + str(self.speed) + " baud" + \
+			(" plus " + str(unknown) + " files of unknown size" if unknown else "")
 
 
 	# Serial comms
 
 	def initialize(self):
-		"""Create serial stream for IO."""
+		"""Create stream for IO. 'tty' can be a serial device, a "socket://host:port"
+		(or "tcp://host:port") URL for a raw TCP connection or a Transport object. The
+		stream is kept in 'serialport' whatever the transport.
+
+		"""
 		if self.xonxoff:
 			self.rtscts = False
-		self.serialport = serial.Serial(self.tty, self.speed, timeout = self.timeout, xonxoff = self.xonxoff, rtscts = self.rtscts)
+		if isinstance(self.tty, Transport):
+			self.serialport = self.tty
+			self.serialport.timeout = self.timeout
+		elif self.tty.startswith(("socket://", "tcp://")):
+			host, port = self.tty.split("://", 1)[1].rsplit(":", 1)
+			self.serialport = TCPTransport(host, int(port), timeout = self.timeout)
+		else:
+			self.serialport = SerialTransport(self.tty, self.speed, timeout = self.timeout, xonxoff = self.xonxoff, rtscts = self.rtscts)
+		self.rxbuf = "" # received bytes not yet consumed by a reply
+		if self.readerbuffer:
+			self.reader = Reader(self.serialport, self.readerbuffer)
+			self.reader.start()
+		self.ident = None # may be a different instrument now
+		self.opc_enabled = False
+		self.invalidate()
 		if self.serialport:
-			self.dbg("Opened serial port " + self.tty, "green")
+			self.dbg("Opened connection to %s", "green", self.tty)
 
 	def close(self):
-		"""Close serial port."""
+		"""Close the connection."""
+		if self.reader:
+			self.reader.stop()
+			self.reader = None
 		self.serialport.close()
-		self.dbg("Closed serial port.", "green")
+		self.dbg("Closed connection.", "green")
 			
-	def sendblock(self, buffer):
-		"""Formats a data block (array.array of integers) with a header and sends it to
-		the instrument.
-		"""
-		ar = array.array('B')
-		self.dbg("Sending datablock (" + str(len(buffer)) + " bytes)", "blue")
-		ar.fromstring("#8" + "%08d" % (len(buffer)))
-		ar.fromstring(buffer + "\n"*32) # Magic newlines to apparently pad the output
-		self.send(ar)
-		self.dbg("Send finished.", "blue")
+	def sendblock(self, buffer, flush = True):
+		"""Formats a data block with a header and sends it to the instrument.
+		The data can be a string, a buffer (bytearray, memoryview, array.array) or a
+		file object, which is streamed from its current position to the end. The
+		header, data and padding are written to the port one after another without
+		copying them into a single buffer first. With flush = False the input isn't
+		drained afterwards (see flush()).
+		"""
+		with self.transaction():
+			length = self.blocklength(buffer)
+			self.dbg("Sending datablock (%d bytes)", "blue", length)
+			self.block_transfer = (length, time.time())
+			try:
+				self.send("#8" + "%08d" % length, flush = False)
+				self.send(buffer, flush = False)
+				self.send("\n"*32, flush = flush) # Magic newlines to apparently pad the output
+			finally:
+				self.block_transfer = None
+			self.dbg("Send finished.", "blue")
+
+	def blocklength(self, data):
+		"""Return the number of bytes in a string, buffer or the rest of a file."""
+		if type(data) == array.array:
+			return len(data) * data.itemsize
+		if not hasattr(data, "read"):
+			return len(data)
+		try:
+			return os.fstat(data.fileno()).st_size - data.tell()
+		except (AttributeError, IOError, OSError, ValueError):
+			pos = data.tell()
+			data.seek(0, 2)
+			end = data.tell()
+			data.seek(pos)
+			return end - pos
 	
-	def flush(self, timeout = 1):
+	def wait_input(self, timeout = None):
+		"""Block until there is data to read from the instrument or 'timeout' seconds
+		have passed, without using the CPU while waiting. A timeout of None waits
+		forever.
+
+		Returns:
+		True if data is available, False on timeout
+
+		"""
+		if self.rxbuf:
+			return True
+		if self.reader:
+			return self.reader.wait(timeout)
+		if self.serialport.inWaiting():
+			return True
+		return self.serialport.wait(timeout)
+
+	def flush(self, timeout = 1, idle = None):
 		"""Flush the input buffer.
 
+		Reads until the link has been quiet for 'idle' seconds (by default the value
+		given to the constructor) or until 'timeout' seconds have passed, whichever
+		comes first, and returns what was read. A timeout of None means no upper limit.
+
 		"""
+		if idle is None:
+			idle = self.idle
 		self.dbg("Flushing input...", "blue")
-		self.serialport.timeout=timeout
-		buf = self.serialport.read(8192*1024) # up to 8MB
-		self.serialport.timeout=self.timeout
-		return buf
+		deadline = time.time() + timeout if timeout is not None else None
+		chunks = [self.rxbuf]
+		self.rxbuf = ""
+		while True:
+			wait = idle
+			if deadline is not None:
+				wait = min(idle, deadline - time.time())
+				if wait <= 0:
+					break
+			data = self.pull(65536, wait)
+			if not data:
+				break # link is quiet
+			chunks.append(data)
+		return "".join(chunks)
+
+	def discard_input(self):
+		"""Throw away buffered and pending input. Anything other than the padding
+		newlines is reported as stray input."""
+		chunks = [self.rxbuf]
+		self.rxbuf = ""
+		while True:
+			if self.reader:
+				data = self.reader.take(65536, 0)
+			else: # whatever is waiting can be read without touching the timeout
+				data = self.serialport.read(self.serialport.inWaiting())
+			if not data:
+				break
+			chunks.append(data)
+		self.stray("".join(chunks))
+
+	def stray(self, data):
+		"""Report input nobody asked for, like replies that came after their query
+		timed out. The last 100 are kept in 'strays' as (time, response) tuples."""
+		responses = [r for r in frames(data) if r.strip()]
+		for r in responses:
+			self.dbg("Stray input: %r%s (%d bytes)", "yellow", r[:60], "..." if len(r) > 60 else "", len(r))
+			self.strays.append((time.time(), r))
+		del self.strays[:-100]
+
+	def pull(self, size, timeout = None):
+		"""Return up to 'size' bytes from the port (or the reader thread), waiting up
+		to 'timeout' seconds for the first one. Returns "" on timeout.
+
+		"""
+		if self.reader:
+			return self.reader.take(size, timeout)
+		self.settimeout(timeout)
+		return self.serialport.read(min(size, max(1, self.serialport.inWaiting())))
+
+	def settimeout(self, timeout):
+		"""Set the read timeout of the port. Changing the timeout reconfigures the
+		port, so it's only done when the value actually changes.
+
+		"""
+		if self.serialport.timeout != timeout:
+			self.serialport.timeout = timeout
+
+	def fill(self, timeout = None):
+		"""Read whatever is available from the port into the receive buffer, waiting
+		up to 'timeout' seconds for the first byte.
+
+		Returns:
+		Number of bytes read, 0 on timeout
+
+		"""
+		data = self.pull(65536, timeout)
+		self.rxbuf += data
+		return len(data)
+
+	def read(self, size, timeout = None):
+		"""Read 'size' bytes, first from the receive buffer and then from the port.
+		Returns fewer bytes if 'timeout' seconds pass without any new data.
+
+		"""
+		chunks = [self.rxbuf[:size]]
+		self.rxbuf = self.rxbuf[size:]
+		got = len(chunks[0])
+		while got < size:
+			data = self.pull(size - got, timeout)
+			if not data:
+				break
+			chunks.append(data)
+			got += len(data)
+		return "".join(chunks)
+
+	def readline(self, timeout = None):
+		"""Read a newline-terminated line. Whatever was read past the newline is kept
+		in the receive buffer for the next reply. If 'timeout' seconds pass without
+		new data, the partial line received so far is returned.
+
+		"""
+		start = 0
+		while True:
+			end = self.rxbuf.find("\n", start) + 1
+			if end:
+				line, self.rxbuf = self.rxbuf[:end], self.rxbuf[end:]
+				return line
+			start = len(self.rxbuf)
+			if not self.fill(timeout):
+				line, self.rxbuf = self.rxbuf, ""
+				return line
 	
-	def send(self, data, newline = None, flush = True):
-		"""Simply send data as-is immediately."""
-		self.serialport.timeout = None
-		self.dbg("Sending data of type: " + str(type(data)), "blue")
-		if type(data) == array.array:
+	def send(self, data, newline = None, flush = True, progress = None):
+		"""Simply send data as-is immediately.
+
+		The data is written in chunks of 'chunksize' bytes instead of one byte at a
+		time. Flow control (RTS/CTS or XON/XOFF) is handled by the serial driver, which
+		blocks the writes whenever the instrument can't take more data. Strings and
+		buffers are written through a memoryview and file objects are read into a
+		reused chunk buffer, so the data isn't copied as a whole.
+
+		Arguments:
+		data		-- string, buffer (bytearray, memoryview, array.array) or a
+				   file object to send from its current position to the end
+		flush		-- if True, read and return whatever the instrument replies
+		progress	-- (optional) callback progress(sent, total) called after each
+				   chunk, defaults to printing a debug message every 4096 bytes
+
+		"""
+		with self.transaction():
+			if self.capturing is not None:
+				raise ValueError("Block transfers can't be pipelined")
+			self.send_batch()
+			self.dbg("Sending data of type: %s", "blue", type(data))
+			if not progress:
+				progress = self.progress
+			length = self.blocklength(data)
+			chunksize = self.chunksize if self.chunksize > 0 else max(length, 1)
 			sent = 0
-			ar = array.array('B')
-			length = len(data)
-			for b in data:
-				sent += 1
-				ar.extend([b])
-				if sent % 4096 == 0:
-					self.dbg("Progress: " + str(sent) + " / " + str(length-42) + " + 10 + 32 bytes...", "blue")
-				self.serialport.write(ar)
-				ar.pop()
-		else:
-			self.serialport.write(data)
-		self.serialport.timeout = self.timeout
-		if flush:
-			return self.flush()
-		else:
-			return
+			start = time.time()
+			if hasattr(data, "read") and type(data) != array.array: # array.read is an old name of fromfile
+				view = memoryview(bytearray(chunksize))
+				readinto = getattr(data, "readinto", None)
+				while True:
+					if readinto:
+						n = readinto(view)
+						chunk = view[:n]
+					else:
+						chunk = data.read(chunksize)
+						n = len(chunk)
+					if not n:
+						break
+					self.serialport.write(chunk)
+					sent += n
+					progress(sent, length)
+			else:
+				# arrays only have the old buffer interface in Python 2, slicing a buffer
+				# copies just the chunk
+				view = buffer(data) if type(data) == array.array else memoryview(data)
+				while sent < length:
+					self.serialport.write(view[sent:sent + chunksize])
+					sent = min(sent + chunksize, length)
+					progress(sent, length)
+			self.serialport.flush() # wait until everything is on the wire
+			if length > chunksize:
+				self.transfer_stats(length, time.time() - start)
+			if flush:
+				return self.flush()
+			else:
+				return
+
+	def progress(self, done, total):
+		"""Default progress callback for transfers, prints a message every 4096 bytes."""
+		if done < self.progress_mark: # a new transfer
+			self.progress_mark = 0
+		if done == total or done - self.progress_mark >= 4096:
+			self.progress_mark = done - done % 4096
+			self.dbg("Progress: %d / %d bytes...", "blue", done, total)
+
+	def linerate(self):
+		"""Return the maximum line rate in bytes per second (8N1 = 10 bits per byte)."""
+		return self.speed / 10.0
+
+	def transfer_remaining(self):
+		"""Return the estimated number of seconds left of the block transfer in progress,
+		0 if there isn't one. Blocks can't be interrupted once started."""
+		if not self.block_transfer:
+			return 0
+		size, start = self.block_transfer
+		return max(0, size / self.linerate() - (time.time() - start))
+
+	def transfer_stats(self, numbytes, seconds):
+		"""Record and report throughput of a transfer compared to the line rate.
+		The result is stored in 'last_transfer' as a dict.
+
+		"""
+		rate = numbytes / seconds if seconds > 0 else float(numbytes)
+		efficiency = 100.0 * rate / self.linerate()
+		self.last_transfer = dict(bytes = numbytes, seconds = seconds, rate = rate, efficiency = efficiency)
+		self.dbg("Transferred %d bytes in %.2f s (%.0f B/s, %.1f%% of line rate)", "blue", numbytes, seconds, rate, efficiency)
+		return self.last_transfer
 	
 	def cmd (self, string, wait = None, multiline = None):
 		"""Send a command to the instrument. If wait = True, block until there is a response,
-		otherwise don't wait.
+		otherwise don't wait. Inside batch(), commands that don't wait are queued instead
+		and queries send the queued commands first.
 
 		"""
-		self.dbg("Sending command: '" + string + "'", "blue")
-		self.serialport.write(string + "\n")
-		self.serialport.flush()
-		buffer = ""
-		if wait:
-			if multiline == True:
-				self.dbg("Reading multiline reply...", "blue")
-				return self.readblock()
-			else: 
-				self.dbg("Reading reply...", "blue")
-				while True:
-					self.serialport.timeout = wait
-					byte = self.serialport.read(1)
-					if byte:
-						buffer += byte
-					else:
-						break
-					if '\n' in buffer:
-						break
-		self.serialport.timeout = self.timeout
-		numbytes = len(buffer)
-		if numbytes > 0:
-			self.dbg("Read " + str(numbytes) + " bytes.", "blue")
-		return buffer.rstrip()
+		with self.transaction(short = True):
+			if self.capturing is not None:
+				if not wait or multiline:
+					raise ValueError("Only single-line queries can be pipelined, not '" + string + "'")
+				self.capturing.append((string, wait))
+				raise QueryCaptured
+			if self.replies is not None and wait:
+				self.dbg("Pipelined reply to '%s'", "blue", string)
+				return self.replies.pop(0)
+			if self.batched is not None and not wait:
+				self.dbg("Queued command: '%s'", "blue", string)
+				self.batched.append(string)
+				return ""
+			self.send_batch()
+			if wait and self.wait_input(0):
+				self.discard_input() # left over from earlier, not the reply to this
+			self.dbg("Sending command: '%s'", "blue", string)
+			self.serialport.write(string + "\n")
+			self.serialport.flush()
+			buffer = ""
+			if wait:
+				if multiline == True:
+					self.dbg("Reading multiline reply...", "blue")
+					return self.readblock()
+				else: 
+					self.dbg("Reading reply...", "blue")
+					buffer = self.readline(wait)
+			numbytes = len(buffer)
+			if numbytes > 0:
+				self.dbg("Read %d bytes.", "blue", numbytes)
+			return buffer.rstrip()
 	
+	@contextlib.contextmanager
+	def transaction(self, short = False):
+		"""Run a sequence of operations without other threads using the instrument in
+		between, for example selecting a module and reading its data:
+
+		with hp.transaction():
+			hp.main_select(3)
+			data = hp.syst_data_query()
+
+		Every method is atomic by itself, and the high-level methods group their
+		steps into transactions. Transactions can be nested. Threads waiting to do a
+		single command or query (short = True) go before threads waiting to start a
+		transaction, so long operations made of several transactions don't hold up
+		quick queries.
+
+		"""
+		self.session.acquire(short)
+		try:
+			yield self
+		finally:
+			self.session.release()
+
+	@contextlib.contextmanager
+	def batch(self):
+		"""Collect commands into compound messages instead of sending them one by one.
+		Setter methods called inside the block are queued and sent when it ends,
+		joined with ';' into as few lines as fit in 'maxmessage' characters, so bulk
+		configuration costs a few messages instead of one turnaround per command.
+		Queries and block transfers inside the block send the queue first, so the
+		commands still reach the instrument in order. Nested batches join the
+		outermost one.
+
+		Since all the methods send absolute command headers (':SETC', ':SYST:HEAD'...)
+		the commands can be combined freely. Note that the instrument discards the rest
+		of a message after a command error, check syst_error_query() if in doubt.
+
+		Example:
+		with hp.batch():
+			hp.main_beeper(0)
+			hp.main_setcolor(1, 0, 0, 0)
+			hp.syst_header(0)
+
+		"""
+		with self.transaction(): # the queue is shared, keep other threads out meanwhile
+			outer = self.batched is None
+			if outer:
+				self.batched = []
+			try:
+				yield self
+			finally:
+				if outer:
+					try:
+						self.send_batch()
+					finally:
+						self.batched = None
+
+	def send_batch(self):
+		"""Send the commands queued by batch() so far as compound messages."""
+		if not self.batched:
+			return
+		commands, self.batched[:] = self.batched[:], []
+		lines = [commands[0]]
+		for c in commands[1:]:
+			if len(lines[-1]) + len(c) + 2 > self.maxmessage: # separator and newline
+				lines.append(c)
+			else:
+				lines[-1] += ";" + c
+		self.dbg("Sending %d queued commands in %d messages", "blue", len(commands), len(lines))
+		for line in lines:
+			self.dbg("Sending command: '%s'", "blue", line)
+			self.serialport.write(line + "\n")
+		self.serialport.flush()
+
+	def pipeline(self, *calls):
+		"""Run several query methods with one compound message instead of one turnaround
+		each. The commands of the queries are collected and sent joined with ';' (split
+		into several lines if longer than 'maxmessage'), all lines back to back. The
+		instrument answers each line with the responses separated by ';', which are then
+		handed back to the query methods in order, so every result is parsed exactly as
+		if the method had been called on its own. A query the instrument doesn't answer
+		(after a command error for example) gets an empty reply, as it would alone.
+
+		Only methods that make a single one-line query can be pipelined, others raise
+		ValueError.
+
+		Arguments:
+		calls	-- query methods, or tuples of a query method and its arguments
+
+		Returns:
+		A list of the results, in the same order as the calls
+
+		Example:
+		idn, skew = hp.pipeline(hp.comm_idn_query, (hp.inter_skew_query, 1))
+
+		"""
+		with self.transaction():
+			calls = [c if isinstance(c, tuple) else (c,) for c in calls]
+			queries = []
+			for c in calls:
+				self.capturing = queries
+				captured = len(queries)
+				try:
+					c[0](*c[1:])
+				except QueryCaptured:
+					pass
+				finally:
+					self.capturing = None
+				if len(queries) != captured + 1:
+					raise ValueError(c[0].__name__ + " doesn't make a query and can't be pipelined")
+			lines = [[queries[0]]]
+			for q in queries[1:]:
+				if len(";".join(s for s, w in lines[-1] + [q])) + 1 > self.maxmessage:
+					lines.append([q])
+				else:
+					lines[-1].append(q)
+			self.send_batch()
+			self.dbg("Pipelining %d queries in %d messages", "blue", len(queries), len(lines))
+			for line in lines:
+				message = ";".join(s for s, w in line)
+				self.dbg("Sending command: '%s'", "blue", message)
+				self.serialport.write(message + "\n")
+			self.serialport.flush()
+			replies = []
+			for line in lines:
+				parts = self.split_reply(self.readline(sum(w for s, w in line)).rstrip())
+				replies += (parts + [""] * len(line))[:len(line)]
+			self.replies = replies
+			try:
+				return [c[0](*c[1:]) for c in calls]
+			finally:
+				self.replies = None
+
+	def split_reply(self, string):
+		"""Split a compound response into the responses of its queries at the semicolons
+		that aren't inside quoted strings."""
+		parts = []
+		start = 0
+		quote = None
+		for i, c in enumerate(string):
+			if quote:
+				if c == quote:
+					quote = None
+			elif c in "'\"":
+				quote = c
+			elif c == ";":
+				parts.append(string[start:i])
+				start = i + 1
+		if string:
+			parts.append(string[start:])
+		return parts
+
 	def query (self, string, timeout = 0.2):
 		"""Shorthand to send a command and return a single-line answer from the instrument."""
 		return self.cmd(string, wait = timeout)
@@ -474,6 +1937,7 @@ class HPLA:
 
 		"""
 		self.cmd("*ESE " + str(mask))
+		self.opc_enabled = bool(int(mask) & 1)
 
 	def comm_ese_query(self):
 		"""*ESE (Event Status Enable) Query
@@ -516,7 +1980,7 @@ class HPLA:
 
 
 		"""
-		return self.query_num("*ESR?")
+		return self.record_esr(self.query_num("*ESR?"))
 
 	def comm_idn_query(self):
 		"""*IDN (Identification Number)
@@ -639,6 +2103,7 @@ class HPLA:
 		
 		"""
 		self.cmd("*RST")
+		self.invalidate()
 
 	def comm_sre(self, mask):
 		"""*SRE (Service Request Enable)
@@ -777,7 +2242,11 @@ class HPLA:
 	
 		"""
 		
+		if self.unchanged(":BEEP?", self.onoff(setting)):
+			return
 		self.cmd(":BEEP" + self.opts(setting))
+		if setting is not None:
+			self.remember(":BEEP?", self.onoff(setting))
 	
 	def main_beeper_query(self):
 		"""BEEPer Query
@@ -789,7 +2258,8 @@ class HPLA:
 	
 		"""
 		
-		return self.query_num(":BEEP?")
+		r = self.cached(":BEEP?")
+		return r if r is not None else self.remember(":BEEP?", self.query_num(":BEEP?"))
 
 	def main_capability_query(self):
 		"""CAPability Query
@@ -834,7 +2304,7 @@ class HPLA:
 		assignment for each card. Length of the list will be 10 elements, or 20 if 
 		HP 16501A is connected.
 
-		(see docstring for installed_modules() for table of ID numbers)
+		(see MODULE_NAMES for the table of ID numbers)
 
 		"""
 		return self.query_numlist(":CARDCAGE?")
@@ -1028,7 +2498,11 @@ class HPLA:
 		MENU 0,5			Intermodule menu
 		
 		"""
+		if self.cached(":MENU?") == (module, menu):
+			return
 		self.cmd(":MENU" + self.opts(module, menu))
+		self.invalidate(":SELECT?")
+		self.remember(":MENU?", (module, menu))
 
 	def main_menu_query(self):
 		"""MENU Query
@@ -1039,9 +2513,12 @@ class HPLA:
 		Tuple (module, menu)	-- current menu selection
 
 		"""
+		r = self.cached(":MENU?")
+		if r is not None:
+			return r
 		r = self.query(":MENU?")
 		if str(r):
-			return tuple(int(m) for m in r.split(','))
+			return self.remember(":MENU?", tuple(int(m) for m in r.split(',')))
 
 	def main_mese(self, n, value):
 		"""MESE<N> (Module Event Status Enable)
@@ -1192,7 +2669,10 @@ class HPLA:
 		module	-- integer from -2 to 10, module index to select
 
 		"""
+		if self.cached(":SELECT?") == module:
+			return
 		self.cmd(":SELECT " + str(module))
+		self.remember(":SELECT?", module)
 
 	def main_select_query(self):
 		"""SELect Query
@@ -1203,7 +2683,8 @@ class HPLA:
 		Integer from -2 to 10	-- the current module selection
 
 		"""
-		return self.query_num(":SELECT?")
+		r = self.cached(":SELECT?")
+		return r if r is not None else self.remember(":SELECT?", self.query_num(":SELECT?"))
 
 	def main_setcolor(self, color, hue, sat, lum):
 		"""SETColor
@@ -1222,7 +2703,11 @@ class HPLA:
 		lum	-- integer from 0 to 100, luminosity
 
 		"""
+		key = ":SETC? " + str(color)
+		if self.cached(key) == [color, hue, sat, lum]:
+			return
 		self.cmd(":SETC " + ",".join(map(str, [color, hue, sat, lum])))
+		self.remember(key, [color, hue, sat, lum])
 
 	def main_setcolor_default(self):
 		"""SETColor default
@@ -1231,6 +2716,7 @@ class HPLA:
 
 		"""
 		self.cmd(":SETC DEFAULT")
+		self.invalidate(*[":SETC? " + str(c) for c in range(1, 8)])
 
 	def main_setcolor_query(self, color):
 		"""SETColor Query
@@ -1244,7 +2730,9 @@ class HPLA:
 
 
 		"""
-		return self.query_numlist(":SETC? " + str(color))
+		key = ":SETC? " + str(color)
+		r = self.cached(key)
+		return r if r is not None else self.remember(key, self.query_numlist(key))
 	
 	def main_start(self):
 		"""STARt
@@ -1316,13 +2804,14 @@ class HPLA:
 		query in each of the module Programmer's Guides.
 
 		Arguments:
-		blockdata	-- block of data to be sent (binary string)
+		blockdata	-- block of data to be sent (binary string, buffer or file object)
 		
 		"""
-		self.send(":SYST:DATA ", flush = False) # instead of cmd, use send to avoid newline
-		self.sendblock(blockdata)
+		with self.transaction():
+			self.send(":SYST:DATA ", flush = False) # instead of cmd, use send to avoid newline
+			self.sendblock(blockdata)
 
-	def syst_data_query(self):
+	def syst_data_query(self, dest = None):
 		"""DATA? Query
 
 		:SYSTem:DATA?
@@ -1333,12 +2822,16 @@ class HPLA:
 		commands do not affect the stored data. Since the mainframe does not acquire data,
 		refer to the appropriate module Programmer's Guide for more details.
 
+		Arguments:
+		dest	-- (optional) file-like object or buffer to stream the block into
+
 		Returns:
-		Block data
+		Block data, or the number of bytes received if dest is given
 		
 		"""
-		self.send(":SYST:DATA?" + '\n', flush = False) # don't immediately read the answer
-		return self.readblock()
+		with self.transaction():
+			self.send(":SYST:DATA?" + '\n', flush = False) # don't immediately read the answer
+			return self.readblock(dest = dest)
 		
 	def syst_dsp(self, string):
 		"""DSP (Display)
@@ -1474,7 +2967,10 @@ class HPLA:
 		mode	-- 1/"1"/"ON" or 0/"0"/"OFF"
 
 		"""
+		if self.unchanged(":SYST:HEAD?", self.onoff(mode)):
+			return
 		self.cmd(":SYST:HEAD " + str(mode))
+		self.remember(":SYST:HEAD?", self.onoff(mode))
 		
 	def syst_header_query(self):
 		"""HEADer Query
@@ -1485,7 +2981,8 @@ class HPLA:
 		Integer 0 or 1	-- current state of the HEADer command
 
 		"""
-		return self.query_num(":SYST:HEAD?")
+		r = self.cached(":SYST:HEAD?")
+		return r if r is not None else self.remember(":SYST:HEAD?", self.query_num(":SYST:HEAD?"))
 
 	def syst_longform(self, mode):
 		"""LONGform
@@ -1506,7 +3003,10 @@ class HPLA:
 		mode	-- 1/"1"/"ON" or 0/"0"/"OFF"
 
 		"""
+		if self.unchanged(":SYST:LONG?", self.onoff(mode)):
+			return
 		self.cmd(":SYST:LONG " + str(mode))
+		self.remember(":SYST:LONG?", self.onoff(mode))
 
 	def syst_longform_query(self):
 		"""LONGForm Query
@@ -1517,9 +3017,10 @@ class HPLA:
 		Integer 0 or 1	-- current status of the LONGform command
 
 		"""
-		return self.query_num(":SYST:LONG?")
+		r = self.cached(":SYST:LONG?")
+		return r if r is not None else self.remember(":SYST:LONG?", self.query_num(":SYST:LONG?"))
 
-	def syst_print(self, mode, pathname = "\PRINTED", msus = "INT0", disk = True, start = None, end = None, filetype="PCX"):
+	def syst_print(self, mode, pathname = "\PRINTED", msus = "INT0", disk = True, start = None, end = None, filetype="PCX", wait = True):
 		"""PRINt
 
 		:SYSTem:PRINt ALL[,DISK,<pathname>[,<msus>]]
@@ -1564,21 +3065,26 @@ class HPLA:
 		start		-- integer: if mode is "partial", defines the starting state number
 		end		-- integer: if mode is "partial", defines the ending state number
 		filetype	-- string: "btif", "ctif", "pcx" or "eps"
+		wait		-- boolean: if False, don't wait for the print to finish but
+				   return a Completion handle for it
 
 		"""
-		diskarg = rangearg = typearg = ""
-		if disk and pathname:
-			diskarg = ",DISK,'" + str(pathname) + "'" + ("," + str(msus) if msus != None else "")
-		if mode.lower() == "partial":
-			if not (type(start) is int and type(end) is int):
-				raise Exception("Range not defined for partial print, use start= and end=.")
-			rangearg = "," + str(start) + "," + str(end)
-		if mode.lower() == "screen":
-			if not filetype:
-				raise Exception("No filetype defined for printing.")
-			typearg = "," + filetype
-		self.cmd(":SYST:PRIN " + mode + rangearg + diskarg + typearg)
-		self.comm_opc_query()
+		with self.transaction():
+			diskarg = rangearg = typearg = ""
+			if disk and pathname:
+				diskarg = ",DISK,'" + str(pathname) + "'" + ("," + str(msus) if msus != None else "")
+			if mode.lower() == "partial":
+				if not (type(start) is int and type(end) is int):
+					raise Exception("Range not defined for partial print, use start= and end=.")
+				rangearg = "," + str(start) + "," + str(end)
+			if mode.lower() == "screen":
+				if not filetype:
+					raise Exception("No filetype defined for printing.")
+				typearg = "," + filetype
+			self.cmd(":SYST:PRIN " + mode + rangearg + diskarg + typearg)
+			if not wait:
+				return self.completion()
+			self.comm_opc_query()
 
 	def syst_print_query(self, mode):
 		"""PRINt Query
@@ -1602,8 +3108,9 @@ class HPLA:
 		mode	-- string: "screen" or "all"
 
 		"""
-		self.send(":SYST:PRIN?" + " " + str(mode) + "\n", flush = False)
-		return self.flush()
+		with self.transaction():
+			self.send(":SYST:PRIN?" + " " + str(mode) + "\n", flush = False)
+			return self.flush(timeout = None, idle = 1) # not a block, read until the data stops
 
 	def syst_setup(self, blockdata):
 		"""SETup
@@ -1617,23 +3124,30 @@ class HPLA:
 		SETup Commands".
 
 		Arguments:
-		blockdata	-- binary string
+		blockdata	-- binary string, buffer or file object
 
 		"""
-		self.send(":SYST:SET ")
-		self.sendblock(blockdata)
+		with self.transaction():
+			self.invalidate()
+			self.send(":SYST:SET ", flush = False)
+			self.sendblock(blockdata)
 
-	def syst_setup_query(self):
+	def syst_setup_query(self, dest = None):
 		"""SETup Query
 
 		:SYSTem:SETup?
 
+		Arguments:
+		dest	-- (optional) file-like object or buffer to stream the block into
+
 		Returns:
-	        A block of data that contains the current configuration to the controller.
+	        A block of data that contains the current configuration to the controller,
+		or the number of bytes received if dest is given.
 
 		"""
-		self.send(":SYST:SET?" + '\n', flush = None)
-		return self.readblock()
+		with self.transaction():
+			self.send(":SYST:SET?" + '\n', flush = None)
+			return self.readblock(dest = dest)
 
 
 	# MMEMory subsystem commands
@@ -1716,6 +3230,10 @@ class HPLA:
 		msus	-- (optional) string: Mass Storage Unit Specifier, "INTernal0" for
 			   hard disk, "INTernal1" for floppy
 
+		Returns:
+		List of (name, type, description) tuples, with ALL (name, type, description,
+		"DDMMMYY HH:MM:SS") tuples
+
 		"""
 		
 		fmtstring = '10s1x7s1x32s' # 51 char input
@@ -1726,12 +3244,11 @@ class HPLA:
 			all = "All"
 		parse = struct.Struct(fmtstring).unpack_from
 		listing = self.cmd(":MMEM:CAT?" + self.opts(all, msus), wait = 0.5, multiline = True)
-		# flush extra newline after input
-		self.flush()
+		filetype = lambda t: int(t) if t.strip().lstrip('-').isdigit() else t.strip() # directories aren't numeric
 		if all:
-			mapfun = lambda x: tuple([x[0], int(x[1]), x[2], x[3]])
+			mapfun = lambda x: tuple([x[0], filetype(x[1]), x[2], x[3] + " " + x[4]])
 		else:
-			mapfun = lambda x: tuple([x[0], int(x[1]), x[2]])
+			mapfun = lambda x: tuple([x[0], filetype(x[1]), x[2]])
 		return map(mapfun, map(parse, map(''.join, zip(*[iter(listing)]*n)))) 
 
 	def mmem_cd(self, dirname, msus = None):
@@ -1827,13 +3344,14 @@ class HPLA:
 				   HP 16542A Expansion Card Configuration	-16085
 				   HP 16550A Master Card Configuration		-16096
 				   HP 16550A Expansion Card Configuration	-16095
-		blockdata	-- contents of file as a binary string
+		blockdata	-- contents of file as a binary string, buffer or file object
 		msus		-- string, Mass Storage Unit Specifier, "INTernal0" for hard
 				   disk, "INTernal1" for floppy
 
 		"""
-		self.send(":MMEM:DOWN" + self.opts(self.quote(name), msus, self.quote(description), datatype) + ",")
-		self.sendblock(blockdata)
+		with self.transaction():
+			self.send(":MMEM:DOWN" + self.opts(self.quote(name), msus, self.quote(description), datatype) + ",", flush = False)
+			self.sendblock(blockdata)
 
 	def mmem_initialize(self, format = None, msus = "INTernal1"):
 		"""INITialize
@@ -1863,7 +3381,7 @@ class HPLA:
 		# asks for confirmation to avoid accidents
 		confirm = raw_input("Are you sure you want to FORMAT the disk " + str(msus) + "? Type Yes to confirm: ")
 		if confirm == "Yes":
-			self.dbg("Formatting disk " + str(msus) + "...")
+			self.dbg("Formatting disk %s...", None, msus)
 			self.cmd(":MMEM:INIT" + self.opts(format, msus))
 			self.comm_opc_query()
 			self.dbg("Format finished.")
@@ -1899,6 +3417,7 @@ class HPLA:
 		
 		"""
 		self.cmd(":MMEM:LOAD:CONFIG" + self.opts(self.quote(name), msus, module))
+		self.invalidate()
 
 	def mmem_load_iassembler(self, ia_name, machine, msus = None, module = None):
 		"""LOAD :IASSembler
@@ -1972,6 +3491,7 @@ class HPLA:
 
 		"""
 		self.cmd(":MMEM:MSI " + msus)
+		self.invalidate(":MMEM:MSI?") # the reply is spelled differently, ask next time
 
 	def mmem_msi_query(self):
 		"""MSI (Mass Storage Is) Query
@@ -1982,7 +3502,8 @@ class HPLA:
 		String	-- current MSI setting
 
 		"""
-		return self.query(":MMEM:MSI?")
+		r = self.cached(":MMEM:MSI?")
+		return r if r is not None else self.remember(":MMEM:MSI?", self.query(":MMEM:MSI?"))
 
 	def mmem_pack(self, msus = None):
 		"""PACK
@@ -2107,7 +3628,7 @@ class HPLA:
 		"""
 		self.cmd(":MMEM:STOR" + self.opts(self.quote(name), msus, self.quote(description), module))
 
-	def mmem_upload_query(self, name, msus = None):
+	def mmem_upload_query(self, name, msus = None, timeout = 30, dest = None):
 		"""UPLoad Query
 
 		:MMEMory:UPLoad? <name>[,<msus>]
@@ -2131,14 +3652,20 @@ class HPLA:
 			   \NAME_DIR\FILENAME when file outside working directory
 		msus	-- (optional) string, Mass Storage Unit Specifier, "INTernal0" for
 			   hard disk, "INTernal1" for floppy
+		timeout	-- (optional) seconds to wait for the transfer to begin, raises
+			   HPLATimeout if nothing arrives (eg. the file doesn't exist)
+		dest	-- (optional) file-like object or buffer to stream the file into
+
+		Returns:
+		Contents of the file, or the number of bytes received if dest is given
 
 		"""
-		self.send(":MMEM:UPL?" + self.opts(self.quote(name), msus) + '\n', flush = False)
-		# wait for transfer to begin
-		while 1:
-			if self.serialport.inWaiting() > 1:
-				break
-		return self.readblock(timeout=3)
+		with self.transaction():
+			self.send(":MMEM:UPL?" + self.opts(self.quote(name), msus) + '\n', flush = False)
+			# wait for transfer to begin
+			if not self.wait_input(timeout):
+				raise HPLATimeout("No reply to upload query for '" + str(name) + "' in " + str(timeout) + " seconds")
+			return self.readblock(timeout=3, dest = dest)
 
 	def mmem_volume_query(self, msus = None):
 		"""VOLume Query
@@ -2177,6 +3704,7 @@ class HPLA:
 
 		"""
 		self.cmd(":INT:DEL " + str(module))
+		self.ident = None
 
 	def inter_htime_query(self):
 		"""HTIMe Query
@@ -2241,6 +3769,7 @@ class HPLA:
 
 		"""
 		self.cmd(":INT:INS" + self.opts(module, location))
+		self.ident = None
 
 	def inter_portedge(self, edge_spec):
 		"""PORTEDGE
@@ -2356,7 +3885,7 @@ class HPLA:
 		if len(modulelist) == 6:
 			self.cmd(":INT:TREE " + ",".join(str(m) for m in modulelist))
 		else:
-			self.dbg("Invalid length for intermodule tree module list (should be 6): " + str(modulelist))
+			self.dbg("Invalid length for intermodule tree module list (should be 6): %s", None, modulelist)
 
 	def inter_tree_query(self):
 		"""TREE Query
@@ -2397,4 +3926,870 @@ class HPLA:
 
 		"""
 		return self.query_numlist(":INT:TTIM?")
-	
+
+
+class Future(object):
+	"""The eventual result of a call made through AsyncHPLA."""
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.finished = False
+		self.value = None
+		self.error = None
+		self.callbacks = []
+
+	def done(self):
+		"""Return True if the call has finished."""
+		return self.finished
+
+	def wait(self, timeout = None):
+		"""Block until the call has finished, raises HPLATimeout after 'timeout' seconds."""
+		with self.condition:
+			if not self.finished:
+				self.condition.wait(timeout)
+			if not self.finished:
+				raise HPLATimeout("Call didn't finish in " + str(timeout) + " seconds")
+
+	def result(self, timeout = None):
+		"""Return the value the call returned, or raise the exception it raised."""
+		self.wait(timeout)
+		if self.error:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.value
+
+	def exception(self, timeout = None):
+		"""Return the exception the call raised, or None."""
+		self.wait(timeout)
+		return self.error[1] if self.error else None
+
+	def add_done_callback(self, fn):
+		"""Call fn(future) when the call finishes, right away if it already has. The
+		callback runs in the thread that finished the call."""
+		with self.condition:
+			if not self.finished:
+				self.callbacks.append(fn)
+				return
+		fn(self)
+
+	def finish(self, value = None, error = None):
+		with self.condition:
+			self.value = value
+			self.error = error
+			self.finished = True
+			self.condition.notify_all()
+			callbacks, self.callbacks = self.callbacks, []
+		for fn in callbacks:
+			fn(self)
+
+
+class AsyncHPLA:
+	"""Front end for an HPLA that returns Futures. Every method call is queued to a
+	thread that owns the connection and does the (blocking) I/O, and returns a
+	Future at once, so one program can drive
+	several instruments (and other equipment) concurrently. Calls to the same
+	instrument run one at a time in the order they were made.
+
+	The command methods (comm_*, main_*, syst_*, mmem_*, inter_*) and the high-level
+	methods of HPLA are available with the same arguments, and transaction() works
+	like HPLA.transaction(). call() runs any function on the HPLA in the worker
+	thread, for example to use batch().
+
+	For event loops, fileno() becomes readable whenever calls have finished and
+	completed() returns them, so the object can be passed to select() or registered
+	with a reactor. Finished calls are only kept for completed() once fileno() or
+	completed() has been called, so programs that just use the Futures don't collect
+	them.
+
+	Example:
+	a = AsyncHPLA("/dev/ttyUSB0")
+	b = AsyncHPLA("/dev/ttyUSB1")
+	idn_a, idn_b = a.comm_idn_query(), b.comm_idn_query()
+	print idn_a.result(), idn_b.result()
+
+	"""
+
+	def __init__(self, *args, **kwargs):
+		"""Takes an existing HPLA or the same arguments as HPLA. The connection is
+		opened in the worker thread, check ready() for errors."""
+		self.hp = args[0] if len(args) == 1 and not kwargs and isinstance(args[0], HPLA) else None
+		self.calls = Queue.Queue()
+		self.finished = []
+		self.lock = threading.Lock()
+		self.rfd = self.wfd = None # created by fileno()
+		self.ready = self.call(lambda hp: hp) if self.hp else self.submit(lambda: self.connect(*args, **kwargs))
+		self.thread = threading.Thread(target = self.run, name = "AsyncHPLA")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def connect(self, *args, **kwargs):
+		self.hp = HPLA(*args, **kwargs)
+		return self.hp
+
+	def run(self):
+		"""Worker thread: run queued calls until close()."""
+		while True:
+			fn, future = self.calls.get()
+			if fn is None:
+				future.finish()
+				break
+			watched = self.rfd is not None # before the caller can see the result
+			try:
+				future.finish(fn())
+			except Exception:
+				future.finish(error = sys.exc_info())
+			if not watched:
+				continue
+			with self.lock:
+				self.finished.append(future)
+			try:
+				os.write(self.wfd, "x")
+			except OSError: # full, it's readable anyway
+				pass
+
+	def submit(self, fn):
+		future = Future()
+		self.calls.put((fn, future))
+		return future
+
+	def call(self, fn, *args, **kwargs):
+		"""Run fn(hp, *args, **kwargs) in the worker thread, returns a Future."""
+		return self.submit(lambda: fn(self.hp, *args, **kwargs))
+
+	def __getattr__(self, name):
+		method = getattr(HPLA, name, None)
+		if name.startswith("_") or not callable(method) or name in ("batch", "pipeline"):
+			raise AttributeError(name)
+		def queued(*args, **kwargs):
+			return self.submit(lambda: getattr(self.hp, name)(*args, **kwargs))
+		queued.__name__ = name
+		queued.__doc__ = method.__doc__
+		return queued
+
+	@contextlib.contextmanager
+	def transaction(self):
+		"""Run the calls made inside the 'with' block without other threads using the
+		HPLA in between, see HPLA.transaction(). The worker thread holds the session
+		from the first of the calls to the last, so the block itself doesn't wait."""
+		self.call(lambda hp: hp.session.acquire())
+		try:
+			yield self
+		finally:
+			self.call(lambda hp: hp.session.release())
+
+	def fileno(self):
+		"""File descriptor that is readable when calls have finished."""
+		with self.lock:
+			if self.rfd is None:
+				self.rfd, self.wfd = os.pipe()
+				for fd in (self.rfd, self.wfd):
+					if fcntl:
+						fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+			return self.rfd
+
+	def completed(self):
+		"""Return the Futures that have finished since the last call (the first call
+		starts keeping track and returns those that finished after fileno() was
+		first called)."""
+		self.fileno()
+		try:
+			while os.read(self.rfd, 4096):
+				pass
+		except OSError:
+			pass
+		with self.lock:
+			finished, self.finished = self.finished, []
+		return finished
+
+	def close(self):
+		"""Finish the queued calls, close the connection and stop the worker thread."""
+		self.call(lambda hp: hp.close() if hp else None)
+		done = self.submit(None)
+		done.wait()
+		self.thread.join()
+		if self.rfd is not None:
+			os.close(self.rfd)
+			os.close(self.wfd)
+
+
+class GroupResult(dict):
+	"""Results of a call made through HPLAGroup: a dictionary from instrument name to
+	the value the call returned there. The instruments where the call failed are
+	left out and their exceptions are in 'errors' instead."""
+
+	def __init__(self):
+		dict.__init__(self)
+		self.errors = {}
+
+	def ok(self):
+		"""Return True if the call succeeded on all the instruments."""
+		return not self.errors
+
+
+class HPLAGroup:
+	"""Drive several instruments in parallel. Each instrument has an AsyncHPLA of its
+	own, so a method called on the group runs on all of them at the same time and
+	takes about as long as the slowest one. The call returns a GroupResult with the
+	result or the error of each instrument; an error on one instrument doesn't stop
+	the others.
+
+	The instruments are named after their device ("ttyUSB0") unless they are given
+	as a dictionary from name to instrument. "{name}" in string arguments is
+	replaced with the name of each instrument, to give them files of their own.
+	A single instrument is available as group[name].
+
+	Example:
+	rack = HPLAGroup(["/dev/ttyUSB0", "/dev/ttyS0"], speed = 19200)
+	rack.main_start()
+	results = rack.save_data("{name}-data.dat", 3)
+	for name, error in results.errors.items():
+		print name, "failed:", error
+
+	"""
+
+	def __init__(self, instruments, **kwargs):
+		"""Arguments:
+		instruments	-- list of HPLAs or tty arguments of HPLA, or a dictionary from
+				   name to one of these
+		kwargs		-- arguments for the HPLAs opened by the group
+		"""
+		items = instruments.items() if isinstance(instruments, dict) else [(None, i) for i in instruments]
+		self.members = collections.OrderedDict()
+		for index, (name, instrument) in enumerate(items):
+			if name is None:
+				tty = instrument.tty if isinstance(instrument, HPLA) else instrument
+				name = os.path.basename(tty) if isinstance(tty, str) else "instrument" + str(index + 1)
+			if name in self.members:
+				name += "-" + str(index + 1)
+			self.members[name] = AsyncHPLA(instrument) if isinstance(instrument, HPLA) else AsyncHPLA(instrument, **kwargs)
+		self.ready = self.gather(collections.OrderedDict((name, member.ready) for name, member in self.members.items()))
+
+	def names(self):
+		return self.members.keys()
+
+	def __getitem__(self, name):
+		return self.members[name].hp
+
+	def __len__(self):
+		return len(self.members)
+
+	def expand(self, name, value):
+		"""Put the instrument name in place of "{name}" in string arguments."""
+		if isinstance(value, str):
+			return value.replace("{name}", name)
+		if isinstance(value, (list, tuple)):
+			return type(value)(self.expand(name, v) for v in value)
+		if isinstance(value, dict):
+			return dict((k, self.expand(name, v)) for k, v in value.items())
+		return value
+
+	def submit(self, fn):
+		"""Run fn(name, hp) for every instrument in parallel, returns a dictionary from
+		name to Future. Instruments that couldn't be opened get their error."""
+		futures = collections.OrderedDict()
+		for name, member in self.members.items():
+			if member.ready.error: # the group waits until they are open
+				futures[name] = Future()
+				futures[name].finish(error = member.ready.error)
+			else:
+				futures[name] = member.call(lambda hp, name = name: fn(name, hp))
+		return futures
+
+	def gather(self, futures, timeout = None):
+		"""Wait for the Futures of submit() and collect them into a GroupResult. With a
+		'timeout', the calls that haven't finished by then get an HPLATimeout (but keep
+		running)."""
+		deadline = time.time() + timeout if timeout is not None else None
+		results = GroupResult()
+		for name, future in futures.items():
+			try:
+				results[name] = future.result(max(0, deadline - time.time()) if deadline else None)
+			except Exception as e:
+				results.errors[name] = e
+		return results
+
+	def call(self, fn, *args, **kwargs):
+		"""Run fn(hp, *args, **kwargs) on all the instruments in parallel, returns a
+		GroupResult."""
+		return self.gather(self.submit(lambda name, hp: fn(hp, *self.expand(name, args), **self.expand(name, kwargs))))
+
+	def __getattr__(self, name):
+		method = getattr(HPLA, name, None)
+		if name.startswith("_") or not callable(method) or name in ("batch", "transaction"):
+			raise AttributeError(name)
+		def fanout(*args, **kwargs):
+			return self.call(lambda hp, *args, **kwargs: getattr(hp, name)(*args, **kwargs), *args, **kwargs)
+		fanout.__name__ = name
+		fanout.__doc__ = method.__doc__
+		return fanout
+
+	def close(self):
+		"""Finish the queued calls and close all the connections."""
+		for member in self.members.values():
+			member.close()
+
+
+# Scheduling
+
+INTERACTIVE, CONTROL, BULK = 0, 1, 2
+
+# Calls that transfer blocks or use the disk and can take minutes at low speeds
+BULK_METHODS = ("save_data", "load_data", "save_settings", "load_settings", "menumap", "screenshot_menus",
+		"screenshot", "fetch_screenshot", "get", "put", "sync", "sendblock", "readblock", "comm_tst_query",
+		"syst_data", "syst_data_query", "syst_setup", "syst_setup_query", "syst_print", "syst_print_query",
+		"mmem_catalog_query", "mmem_upload_query")
+
+def priority_of(name):
+	"""Return the priority class of an HPLA method: BULK for block transfers and disk
+	operations, INTERACTIVE for quick queries and messages and CONTROL for the rest."""
+	if name in BULK_METHODS or (name.startswith("mmem_") and not name.endswith("_query")):
+		return BULK
+	if (name.endswith("_query") and name != "comm_opc_query") or name in ("syst_dsp", "status", "identity"):
+		return INTERACTIVE
+	return CONTROL
+
+
+class Job(Future):
+	"""A call queued in an HPLAScheduler. 'expected_wait' is the estimated number of
+	seconds it was going to wait when it was submitted."""
+
+	def __init__(self, scheduler, fn, name, priority, estimate):
+		Future.__init__(self)
+		self.scheduler = scheduler
+		self.fn = fn
+		self.name = name
+		self.priority = priority
+		self.estimate = estimate
+		self.expected_wait = 0
+		self.started = None
+
+	def cancel(self):
+		"""Remove the call from the queue if it hasn't started yet. Returns True if it was
+		cancelled, result() then raises HPLACancelled."""
+		return self.scheduler.cancel(self)
+
+	def remaining(self):
+		"""Estimated number of seconds until the call finishes once running."""
+		return max(0, self.estimate - (time.time() - self.started)) if self.started else self.estimate
+
+
+class HPLAScheduler:
+	"""Run calls to an HPLA in priority classes, so quick queries don't wait behind
+	long transfers. Like AsyncHPLA, every method call returns a Future (a Job) at once.
+
+	The classes are INTERACTIVE (quick queries and syst_dsp), CONTROL (other commands)
+	and BULK (block transfers and disk operations), see priority_of(). Bulk calls run
+	one at a time in a thread of their own, in the order they were made. The other
+	calls run in a second thread, interactive ones first, each as a short transaction
+	(see HPLA.transaction()) so they go ahead of the next step of a bulk call. A block
+	that is already being transferred can't be interrupted, but nothing else waits
+	for the rest of the bulk call. Calls of different classes may thus run in a
+	different order than they were made, use call() or a transaction for sequences
+	that depend on each other.
+
+	expected_wait() estimates how long a new call would wait, from the queued calls,
+	the durations of earlier calls and the block transfer in progress. Queued calls
+	can be cancelled with Job.cancel() or all bulk ones with cancel_bulk().
+
+	Example:
+	s = HPLAScheduler("/dev/ttyUSB0")
+	upload = s.mmem_upload_query("BIGFILE")
+	print s.expected_wait(INTERACTIVE), s.comm_stb_query().result()
+
+	"""
+
+	def __init__(self, *args, **kwargs):
+		"""Takes an existing HPLA or the same arguments as HPLA."""
+		self.hp = args[0] if len(args) == 1 and not kwargs and isinstance(args[0], HPLA) else HPLA(*args, **kwargs)
+		self.queues = [collections.deque() for priority in (INTERACTIVE, CONTROL, BULK)]
+		self.running = [None, None] # the jobs in the foreground and bulk threads
+		self.durations = {}
+		self.condition = threading.Condition()
+		self.stopping = False
+		self.threads = []
+		for lane, name in enumerate(("foreground", "bulk")):
+			thread = threading.Thread(target = self.run, args = (lane, ), name = "HPLAScheduler " + name)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def run(self, lane):
+		"""Worker thread: lane 0 runs the interactive and control calls, lane 1 the bulk calls."""
+		while True:
+			with self.condition:
+				job = None
+				while not job:
+					for priority in ((INTERACTIVE, CONTROL), (BULK, ))[lane]:
+						if lane and (self.queues[INTERACTIVE] or self.queues[CONTROL] or self.running[0]):
+							continue # let them go before the next bulk call starts
+						if self.queues[priority]:
+							job = self.queues[priority].popleft()
+							break
+					else:
+						if self.stopping:
+							return
+						self.condition.wait(1)
+				job.started = time.time()
+				self.running[lane] = job
+			begin = job.started
+			try:
+				if lane == 0:
+					with self.hp.transaction(short = True):
+						begin = time.time() # don't count waiting for a block transfer
+						value = job.fn()
+				else:
+					value = job.fn()
+				error = None
+			except Exception:
+				value, error = None, sys.exc_info()
+			with self.condition:
+				self.running[lane] = None
+				seconds = time.time() - begin
+				if job.name:
+					self.durations[job.name] = 0.7 * self.durations.get(job.name, seconds) + 0.3 * seconds
+				self.condition.notify_all()
+			job.finish(value, error)
+
+	def estimate(self, name, args = (), kwargs = {}):
+		"""Estimated duration of a call in seconds: the time the data it sends takes on
+		the line, or the average of the earlier calls of the same method."""
+		size = sum(self.hp.blocklength(value) for value in list(args) + kwargs.values()
+			if isinstance(value, (str, bytearray, memoryview, array.array, file)))
+		return max(size / self.hp.linerate(), self.durations.get(name, (0.05, 0.05, 1.0)[priority_of(name)]))
+
+	def expected_wait(self, priority = INTERACTIVE):
+		"""Estimate how many seconds a call of the given priority class would wait before
+		it starts if it was submitted now."""
+		with self.condition:
+			wait = sum(job.estimate for p in range(priority + 1) for job in self.queues[p])
+			foreground, bulk = self.running
+			if foreground:
+				wait += foreground.remaining()
+			if priority == BULK and bulk:
+				wait += max(bulk.remaining(), self.hp.transfer_remaining())
+			else:
+				wait += self.hp.transfer_remaining()
+			return wait
+
+	def submit(self, fn, priority = BULK, name = None, estimate = None):
+		"""Queue fn() to be run in the given priority class, returns a Job."""
+		job = Job(self, fn, name, priority, self.estimate(name) if estimate is None and name else estimate or 0)
+		with self.condition:
+			if self.stopping:
+				raise RuntimeError("The scheduler has been stopped")
+			job.expected_wait = self.expected_wait(priority)
+			self.queues[priority].append(job)
+			self.condition.notify_all()
+		return job
+
+	def call(self, fn, *args, **kwargs):
+		"""Run fn(hp, *args, **kwargs) as a bulk call, returns a Job."""
+		return self.submit(lambda: fn(self.hp, *args, **kwargs))
+
+	def __getattr__(self, name):
+		method = getattr(HPLA, name, None)
+		if name.startswith("_") or not callable(method) or name in ("batch", "transaction"):
+			raise AttributeError(name)
+		def scheduled(*args, **kwargs):
+			return self.submit(lambda: getattr(self.hp, name)(*args, **kwargs), priority_of(name), name, self.estimate(name, args, kwargs))
+		scheduled.__name__ = name
+		scheduled.__doc__ = method.__doc__
+		return scheduled
+
+	def cancel(self, job):
+		"""Remove a job from the queue, see Job.cancel()."""
+		with self.condition:
+			if job not in self.queues[job.priority]:
+				return False
+			self.queues[job.priority].remove(job)
+		try:
+			raise HPLACancelled(str(job.name or "Call") + " was cancelled")
+		except HPLACancelled:
+			job.finish(error = sys.exc_info())
+		return True
+
+	def cancel_bulk(self):
+		"""Cancel all the bulk calls that haven't started yet, returns them."""
+		with self.condition:
+			jobs = list(self.queues[BULK])
+		return [job for job in jobs if self.cancel(job)]
+
+	def stop(self):
+		"""Finish the queued calls and stop the worker threads. The HPLA is left open."""
+		with self.condition:
+			self.stopping = True
+			self.condition.notify_all()
+		for thread in self.threads:
+			thread.join()
+
+	def close(self):
+		"""Finish the queued calls and close the connection."""
+		self.stop()
+		self.hp.close()
+
+
+# Server
+
+# Methods that HPLAServer runs for its clients: the instrument commands and queries,
+# but nothing that reads or writes files on the server or waits for its console.
+SERVER_METHODS = ("cmd", "query", "query_num", "query_numlist", "identity", "status", "installed_modules",
+	"menumap", "invalidate", "flush_errors", "synctime", "dimscreen", "togglescreen") + tuple(sorted(
+	name for name in vars(HPLA) if name.split("_")[0] in ("comm", "main", "syst", "mmem", "inter") and name != "mmem_initialize"))
+
+def pack(value):
+	"""Convert a value into something JSON can carry. Byte strings that aren't ASCII
+	are sent in base64 and tuples, dictionaries and Identity objects are tagged so
+	that unpack() can restore them."""
+	if isinstance(value, (bytearray, memoryview, array.array)):
+		value = value.tostring() if isinstance(value, array.array) else bytes(value)
+	if isinstance(value, str):
+		try:
+			value.decode("ascii")
+			return value
+		except UnicodeDecodeError:
+			return {"base64": base64.b64encode(value)}
+	if value is None or isinstance(value, (bool, int, long, float, unicode)):
+		return value
+	if isinstance(value, list):
+		return [pack(v) for v in value]
+	if isinstance(value, tuple):
+		return {"tuple": [pack(v) for v in value]}
+	if isinstance(value, dict):
+		return {"dict": [[pack(k), pack(v)] for k, v in value.items()]}
+	if isinstance(value, Identity):
+		return {"identity": [value.idn, value.options, value.cardcage, value.capability]}
+	raise TypeError("Can't send a " + type(value).__name__ + " to the server or back")
+
+def unpack(value):
+	"""Reverse pack()."""
+	if isinstance(value, unicode):
+		try:
+			return value.encode("ascii")
+		except UnicodeEncodeError:
+			return value
+	if isinstance(value, list):
+		return [unpack(v) for v in value]
+	if isinstance(value, dict):
+		tag, content = value.items()[0]
+		if tag == "base64":
+			return base64.b64decode(content)
+		if tag == "tuple":
+			return tuple(unpack(v) for v in content)
+		if tag == "dict":
+			return dict((unpack(k), unpack(v)) for k, v in content)
+		if tag == "identity":
+			return Identity(*unpack(content))
+	return value
+
+def server_address(address):
+	"""Parse a server address: a "tcp://host:port" URL for a TCP socket, otherwise the
+	path of a Unix socket (optionally as a "unix://path" URL). Returns the address
+	family and the address for the socket module."""
+	if address.startswith("tcp://"):
+		host, port = address[len("tcp://"):].rsplit(":", 1)
+		return socket.AF_INET, (host, int(port))
+	if address.startswith("unix://"):
+		address = address[len("unix://"):]
+	return socket.AF_UNIX, address
+
+
+class ServerClient(object):
+	"""A connection to HPLAServer and the requests it has queued."""
+
+	def __init__(self, conn, name):
+		self.conn = conn
+		self.name = name
+		self.requests = collections.deque()
+		self.busy = False
+		self.transactions = 0
+		self.closed = False
+		self.lock = threading.Lock()
+
+	def reply(self, message):
+		"""Send a message to the client, returns False if it has gone away."""
+		try:
+			with self.lock:
+				self.conn.sendall(json.dumps(message) + "\n")
+			return True
+		except socket.error:
+			self.closed = True
+			return False
+
+
+class HPLAServer:
+	"""Share one HPLA between processes. The server owns the connection to the
+	instrument and listens on a Unix or TCP socket (see server_address()) for
+	HPLAClient connections. The requests are run by an HPLAScheduler, one request of
+	each client at a time, so the clients take turns and a client sending many
+	requests doesn't hold up the others, and quick queries don't wait for other
+	clients' bulk transfers. Because the HPLA stays open, its identity, menu map and
+	state cache stay warm from one client to the next.
+
+	The messages are lines of JSON. A request is {"id": n, "method": name, "args":
+	[...], "kwargs": {...}} and the reply is {"id": n, "result": value} or {"id": n,
+	"error": [exception name, message]}, with the values converted by pack(). The
+	methods "begin" and "end" start and end a transaction, during which only the
+	requests of that client are run, and "expected_wait" returns the estimated number
+	of seconds the method given as its argument would wait for its turn.
+
+	Only the methods in SERVER_METHODS can be called, so clients can't make the server
+	read or write its own files: to save a block, get it with syst_data_query() or
+	mmem_upload_query() and write it on the client's side. There is no authentication,
+	so TCP addresses must be on the loopback interface.
+
+	Example:
+	server = HPLAServer(HPLA("/dev/ttyUSB0"), "/tmp/ghettoib.sock")
+	server.serve_forever()
+
+	"""
+
+	def __init__(self, hp, address):
+		"""Arguments:
+		hp	-- the HPLA to share
+		address	-- socket path or "tcp://host:port" to listen on
+		"""
+		self.hp = hp
+		self.address = address
+		self.family, self.sockaddr = server_address(address)
+		if self.family == socket.AF_INET and not socket.gethostbyname(self.sockaddr[0]).startswith("127."):
+			raise ValueError("Refusing to listen on " + address + " without authentication, use a loopback address")
+		self.clients = []
+		self.condition = threading.Condition()
+		self.running = True
+		self.count = 0
+		if self.family == socket.AF_UNIX and os.path.exists(self.sockaddr):
+			probe = socket.socket(socket.AF_UNIX)
+			try:
+				probe.connect(self.sockaddr)
+				raise socket.error("A server is already listening on " + self.sockaddr)
+			except socket.error as e:
+				if e.errno is None:
+					raise
+				os.unlink(self.sockaddr) # left behind by a server that is gone
+			finally:
+				probe.close()
+		self.listener = socket.socket(self.family)
+		if self.family == socket.AF_INET:
+			self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(self.sockaddr)
+		self.listener.listen(16)
+		self.hp.identity() # warm up before the first client
+		self.scheduler = HPLAScheduler(hp)
+		self.hp.dbg("Serving %s on %s", "green", self.hp.tty, address)
+
+	def serve_forever(self):
+		"""Accept clients until close()."""
+		while self.running:
+			try:
+				conn, peer = self.listener.accept()
+			except socket.error:
+				if self.running:
+					raise
+				break
+			if self.family == socket.AF_INET:
+				conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.count += 1
+			client = ServerClient(conn, "client " + str(self.count) + (" (" + peer[0] + ")" if peer else ""))
+			with self.condition:
+				self.clients.append(client)
+			thread = threading.Thread(target = self.receive, args = (client, ), name = client.name)
+			thread.daemon = True
+			thread.start()
+			self.hp.dbg("Connected %s", "green", client.name)
+
+	def start(self):
+		"""Accept clients in a background thread. Returns the server."""
+		thread = threading.Thread(target = self.serve_forever, name = "HPLAServer accept")
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def receive(self, client):
+		"""Connection thread: queue the requests of one client."""
+		f = client.conn.makefile("rb")
+		try:
+			for line in iter(f.readline, ""):
+				try:
+					request = json.loads(line)
+				except ValueError as e:
+					client.reply(dict(id = None, error = ["ValueError", "Bad request: " + str(e)]))
+					continue
+				with self.condition:
+					client.requests.append(request)
+					self.condition.notify_all()
+				self.feed(client)
+		except socket.error:
+			pass
+		f.close()
+		with self.condition:
+			client.closed = True
+			self.clients.remove(client)
+			self.condition.notify_all()
+		self.hp.dbg("Disconnected %s", "green", client.name)
+
+	def feed(self, client):
+		"""Give the next request of a client to the scheduler once the previous one has
+		finished, which keeps the requests of each client in order."""
+		with self.condition:
+			if client.busy or not client.requests or client.closed:
+				return
+			request = client.requests.popleft()
+			method = str(request.get("method"))
+			if method == "expected_wait":
+				client.reply(dict(id = request.get("id"), result = self.scheduler.expected_wait(priority_of(str(unpack(request.get("args", [""])[0]))))))
+				return self.feed(client)
+			client.busy = True
+		if method == "begin":
+			job = self.scheduler.submit(lambda: self.serve_transaction(client, request), CONTROL, "begin")
+		else:
+			job = self.scheduler.submit(lambda: self.run(request), priority_of(method), method)
+		job.add_done_callback(lambda job: self.finish(client, request, job))
+
+	def finish(self, client, request, job):
+		"""Send the result of a request and go on with the next one of the client."""
+		error = job.exception()
+		if error or request.get("method") != "begin": # a transaction answers its requests itself
+			client.reply(self.answer(request, job.value, error))
+		with self.condition:
+			client.busy = False
+		self.feed(client)
+
+	def answer(self, request, value, error = None):
+		if error:
+			return dict(id = request.get("id"), error = [type(error).__name__, str(error)])
+		try:
+			return dict(id = request.get("id"), result = pack(value))
+		except TypeError as e:
+			return dict(id = request.get("id"), error = ["TypeError", str(e)])
+
+	def serve_transaction(self, client, begin):
+		"""Run the requests of one client until it ends the transaction it has begun,
+		holding the HPLA session so that nothing else gets in between."""
+		with self.hp.transaction():
+			client.transactions = 1
+			client.reply(self.answer(begin, None))
+			while client.transactions:
+				with self.condition:
+					while not client.requests and not client.closed:
+						self.condition.wait(1)
+					if client.closed:
+						break
+					request = client.requests.popleft()
+				method = request.get("method")
+				if method in ("begin", "end"):
+					client.transactions += 1 if method == "begin" else -1
+					client.reply(self.answer(request, None))
+					continue
+				try:
+					client.reply(self.answer(request, self.run(request)))
+				except Exception as e:
+					client.reply(self.answer(request, None, e))
+			client.transactions = 0
+
+	def run(self, request):
+		"""Run one request, returns its result."""
+		method = request.get("method")
+		if method == "end":
+			raise ValueError("No transaction to end")
+		if not method or method not in SERVER_METHODS:
+			raise AttributeError(str(method) + " is not in SERVER_METHODS, it can't be called remotely")
+		kwargs = dict((str(k), unpack(v)) for k, v in request.get("kwargs", {}).items())
+		return getattr(self.hp, method)(*unpack(request.get("args", [])), **kwargs)
+
+	def close(self):
+		"""Stop serving. The HPLA is left open."""
+		self.running = False
+		with self.condition:
+			self.condition.notify_all()
+			clients = list(self.clients)
+		try:
+			self.listener.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.listener.close()
+		for client in clients:
+			try:
+				client.conn.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+		self.scheduler.stop()
+		if self.family == socket.AF_UNIX and os.path.exists(self.sockaddr):
+			os.unlink(self.sockaddr)
+
+
+class HPLAClient:
+	"""Thin client for HPLAServer, with the same methods as HPLA. Every call is sent to
+	the server, which runs it on its own HPLA and sends back the result or the
+	exception (HPLATimeout, or HPLARemoteError for anything else). Arguments and
+	results can be what pack() handles and only the methods in SERVER_METHODS are
+	available, so file objects and the methods using files on the host (save(), get(),
+	sync() and so on) can't be used: fetch the data and write it locally instead.
+
+	Example:
+	hp = HPLAClient("/tmp/ghettoib.sock")
+	print hp.comm_idn_query()
+	with hp.transaction():
+		hp.main_select(3)
+		data = hp.syst_data_query()
+
+	"""
+
+	def __init__(self, address, timeout = None):
+		"""Arguments:
+		address	-- socket path or "tcp://host:port" of the server
+		timeout	-- seconds to wait for a reply, None waits as long as it takes
+		"""
+		family, sockaddr = server_address(address)
+		self.sock = socket.socket(family)
+		self.sock.settimeout(timeout)
+		self.sock.connect(sockaddr)
+		if family == socket.AF_INET:
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.replies = self.sock.makefile("rb")
+		self.lock = threading.Lock()
+		self.count = 0
+
+	def call(self, method, *args, **kwargs):
+		"""Run an HPLA method in the server and return its result."""
+		with self.lock:
+			self.count += 1
+			self.sock.sendall(json.dumps(dict(id = self.count, method = method, args = pack(list(args)), kwargs = dict((k, pack(v)) for k, v in kwargs.items()))) + "\n")
+			line = self.replies.readline()
+		if not line:
+			raise HPLARemoteError("The server closed the connection")
+		reply = json.loads(line)
+		if "error" in reply:
+			name, message = reply["error"]
+			if name == "HPLATimeout":
+				raise HPLATimeout(message)
+			raise HPLARemoteError(name + ": " + message)
+		return unpack(reply.get("result"))
+
+	def expected_wait(self, method = "comm_stb_query"):
+		"""Return the estimated number of seconds a call of 'method' would wait for its
+		turn in the server, see HPLAScheduler.expected_wait()."""
+		return self.call("expected_wait", method)
+
+	def __getattr__(self, name):
+		method = getattr(HPLA, name, None)
+		if name not in SERVER_METHODS:
+			raise AttributeError(name)
+		def remote(*args, **kwargs):
+			return self.call(name, *args, **kwargs)
+		remote.__name__ = name
+		remote.__doc__ = method.__doc__
+		return remote
+
+	@contextlib.contextmanager
+	def transaction(self):
+		"""Run the calls made inside the 'with' block without other clients' requests
+		(or other threads of the server) in between, see HPLA.transaction()."""
+		self.call("begin")
+		try:
+			yield self
+		finally:
+			self.call("end")
+
+	def close(self):
+		"""Disconnect from the server. The instrument connection stays open."""
+		self.replies.close()
+		self.sock.close()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+"""
+
+ghettoIB benchmark: command latency and block throughput
+
+Runs the library against the simulated HP 16500B (hpsim.py), which is started on a
+pseudo-terminal in a separate process so that the measured CPU time is the library's own.
+Results are printed and saved as JSON, and two result files can be compared:
+
+	$ python hp-bench.py --baud 19200 115200 --sizes 1024 16384 --output new.json
+	$ python hp-bench.py --compare old.json new.json
+
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import ghettoib
+
+HPSIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hpsim.py")
+
+
+def start_sim(baud, disk_latency):
+	"""Start the simulator in its own process, returns (process, device name)."""
+	proc = subprocess.Popen([sys.executable, "-u", HPSIM, "--baud", str(baud), "--disk-latency", str(disk_latency)], stdout = subprocess.PIPE)
+	line = proc.stdout.readline()
+	return proc, line.split()[-1]
+
+def percentile(samples, p):
+	"""Nearest-rank percentile of a list of samples."""
+	s = sorted(samples)
+	return s[max(0, int(math.ceil(p / 100.0 * len(s))) - 1)]
+
+def cputime():
+	t = os.times()
+	return t[0] + t[1]
+
+def measure(fn, n):
+	"""Call fn n times, returns (list of wall clock latencies, CPU seconds used)."""
+	samples = []
+	cpu = cputime()
+	for i in range(n):
+		start = time.time()
+		fn()
+		samples.append(time.time() - start)
+	return samples, cputime() - cpu
+
+def latency_result(name, samples, cpu):
+	return dict(op = name, n = len(samples),
+		latency = dict((k, percentile(samples, p)) for k, p in (("p50", 50), ("p90", 90), ("p99", 99))),
+		mean = sum(samples) / len(samples), cpu_per_call = cpu / len(samples))
+
+def throughput_result(name, size, samples, cpu, linerate):
+	total = size * len(samples)
+	rate = total / sum(samples)
+	return dict(op = name, size = size, n = len(samples), rate = rate,
+		efficiency = 100.0 * rate / linerate, cpu_per_mb = cpu * 1048576.0 / total)
+
+def bench(baud, sizes, repeat, disk_latency, menumap):
+	"""Run the benchmarks at one baud rate, returns a list of results."""
+	proc, device = start_sim(baud, disk_latency)
+	try:
+		hp = ghettoib.HPLA(device, baud, debug = False, rtscts = False, cachedir = None) # a pty has no handshake lines
+	except:
+		proc.terminate()
+		raise
+	tmp = tempfile.mkdtemp()
+	results = []
+	try:
+		for op, fn in (("query", hp.comm_idn_query), ("query_numlist", hp.main_cardcage_query)):
+			results.append(latency_result(op, *measure(fn, repeat * 10)))
+		for i in range(10):
+			hp.mmem_download("BENCH%d.DAT" % i, "benchmark", -5813, "x" * 100)
+		results.append(latency_result("mmem_catalog_query", *measure(lambda: hp.mmem_catalog_query(all = True), repeat)))
+		hp.main_select(3)
+		for size in sizes:
+			data = os.urandom(size)
+			# a pty accepts the whole block at once, so wait until the simulator has taken it all
+			# in, and skip syst_data's idle drain of the input, which isn't part of the transfer
+			samples, cpu = measure(lambda: (hp.send(":SYST:DATA ", flush = False), hp.sendblock(data, flush = False), hp.comm_opc_query()), repeat)
+			results.append(throughput_result("sendblock", size, samples, cpu, hp.linerate()))
+			samples, cpu = measure(hp.syst_data_query, repeat)
+			results.append(throughput_result("readblock", size, samples, cpu, hp.linerate()))
+		results.append(latency_result("screenshot", *measure(lambda: hp.screenshot(os.path.join(tmp, "screen.png")), repeat)))
+		if menumap:
+			results.append(latency_result("menumap", *measure(hp.menumap, 1)))
+	finally:
+		hp.close()
+		proc.terminate()
+		shutil.rmtree(tmp)
+	for r in results:
+		r["baud"] = baud
+	return results
+
+def describe(r):
+	if "rate" in r:
+		return "%7.0f B/s %6.1f%% of line rate %8.3f s CPU/MB" % (r["rate"], r["efficiency"], r["cpu_per_mb"])
+	return "p50 %7.1f ms p90 %7.1f ms p99 %7.1f ms %7.2f ms CPU/call" % tuple([1000 * r["latency"][k] for k in ("p50", "p90", "p99")] + [1000 * r["cpu_per_call"]])
+
+def key(r):
+	return (r["baud"], r["op"], r.get("size"))
+
+def compare(old, new):
+	"""Print the change of each result between two result files."""
+	before = dict((key(r), r) for r in old["results"])
+	print "Comparing " + old["label"] + " -> " + new["label"]
+	for r in new["results"]:
+		o = before.get(key(r))
+		if not o:
+			continue
+		if "rate" in r:
+			change = "rate %+6.1f%%, CPU/MB %+6.1f%%" % (100.0 * (r["rate"] / o["rate"] - 1), 100.0 * (r["cpu_per_mb"] / o["cpu_per_mb"] - 1) if o["cpu_per_mb"] else 0)
+		else:
+			change = "p50 %+6.1f%%, CPU/call %+6.1f%%" % (100.0 * (r["latency"]["p50"] / o["latency"]["p50"] - 1), 100.0 * (r["cpu_per_call"] / o["cpu_per_call"] - 1) if o["cpu_per_call"] else 0)
+		print "%6d %-20s %8s  %s" % (r["baud"], r["op"], r.get("size", ""), change)
+
+def label():
+	"""Name of the version being benchmarked, from git if possible."""
+	try:
+		return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd = os.path.dirname(HPSIM)).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Benchmark ghettoIB against the simulated HP 16500B.")
+	parser.add_argument("--baud", type = int, nargs = "+", default = [19200, 115200], help = "baud rates to run at")
+	parser.add_argument("--sizes", type = int, nargs = "+", default = [1024, 16384], help = "block sizes in bytes")
+	parser.add_argument("--repeat", type = int, default = 5, help = "repetitions of each operation (x10 for queries)")
+	parser.add_argument("--disk-latency", type = float, default = 0.0, help = "simulated disk latency in seconds")
+	parser.add_argument("--menumap", action = "store_true", help = "also time menumap (slow)")
+	parser.add_argument("--label", default = None, help = "name of this run, defaults to git describe")
+	parser.add_argument("--output", default = "bench.json", help = "JSON file for the results")
+	parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"), help = "compare two result files and exit")
+	opts = parser.parse_args()
+	if opts.compare:
+		compare(*[json.load(open(f)) for f in opts.compare])
+		sys.exit(0)
+	results = []
+	for baud in opts.baud:
+		for r in bench(baud, opts.sizes, opts.repeat, opts.disk_latency, opts.menumap):
+			print "%6d %-20s %8s  %s" % (r["baud"], r["op"], r.get("size", ""), describe(r))
+			results.append(r)
+	with open(opts.output, "w") as f:
+		json.dump(dict(label = opts.label or label(), date = datetime.now().isoformat(), python = sys.version.split()[0], results = results), f, indent = 1)
+	print "Saved results to " + opts.output
@@ -11,5 +11,7 @@ import ghettoib
 hp = ghettoib.HPLA("/dev/ttyUSB0", 19200)
 #hp2 = ghettoib.HPLA("/dev/ttyS0", 19200, xonxoff = True)
 #test = ghettoib.HPLA("/dev/pts/1", 19200)
+#import hpsim; test = ghettoib.HPLA(hpsim.HPSim().connect())
+#rack = ghettoib.HPLAGroup([hp, "/dev/ttyS0"], speed = 19200)
 
 #### Add your own control functions below!
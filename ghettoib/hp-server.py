@@ -0,0 +1,38 @@
+#!/usr/bin/python
+"""
+
+ghettoIB instrument server
+
+Keeps the connection to one instrument open and lets any number of programs use it at
+the same time through HPLAClient:
+
+	$ python hp-server.py /dev/ttyUSB0 --socket /tmp/ghettoib.sock
+
+	>>> hp = ghettoib.HPLAClient("/tmp/ghettoib.sock")
+	>>> hp.comm_idn_query()
+
+"""
+
+import argparse
+
+import ghettoib
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Share an HP 16500B connection between programs.")
+	parser.add_argument("tty", nargs = "?", default = "/dev/ttyUSB0", help = "serial device or tcp://host:port of the instrument")
+	parser.add_argument("--baud", type = int, default = 19200, help = "serial port speed")
+	parser.add_argument("--xonxoff", action = "store_true", help = "use software flow control instead of RTS/CTS")
+	parser.add_argument("--socket", default = "/tmp/ghettoib.sock", help = "Unix socket path or tcp://127.0.0.1:port to listen on (loopback only)")
+	parser.add_argument("--no-statecache", action = "store_true", help = "always ask the instrument for settings")
+	parser.add_argument("--quiet", action = "store_true", help = "don't print debug messages")
+	opts = parser.parse_args()
+	hp = ghettoib.HPLA(opts.tty, opts.baud, debug = not opts.quiet, xonxoff = opts.xonxoff, statecache = not opts.no_statecache)
+	server = ghettoib.HPLAServer(hp, opts.socket)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
+		hp.close()
@@ -0,0 +1,933 @@
+# -*- coding: utf8 -*-
+import os
+import tty
+import time
+import struct
+import argparse
+import threading
+from datetime import datetime, timedelta
+from ghettoib import PipeTransport, MONTHS
+
+"""
+
+Simulated HP 16500B Logic Analysis System mainframe for ghettoIB.
+
+Understands the mainframe command set implemented in ghettoib.py well enough to run the
+library without an instrument: it keeps the mainframe settings, the status registers and
+the error queue, stores files on simulated disks, and throttles its I/O to the baud rate
+and adds disk latency like the real thing would. It runs either in the same process over
+a PipeTransport or on a pseudo-terminal that HPLA opens like any serial port:
+
+	$ python hpsim.py --baud 19200
+	Simulated HP 16500B on /dev/pts/5
+
+	>>> sim = hpsim.HPSim(baud = 19200)
+	>>> hp = ghettoib.HPLA(sim.connect())
+
+Only the mainframe is simulated, the modules just return blocks of made-up data.
+
+"""
+
+
+IDN = "HEWLETT-PACKARD,16500B,0,REV 03.00"
+CAPABILITY = "IEEE488,1987,SH1,AH1,T5,L4,SR1,RL1,PP1,DC1,DT1,C0,E2"
+DEFAULT_COLORS = {1: (0, 0, 100), 2: (0, 0, 50), 3: (57, 100, 67), 4: (33, 100, 50), 5: (57, 100, 67), 6: (8, 100, 65), 7: (17, 100, 56)}
+DIRECTORY_TYPE = "DIR"
+
+ERRORS = {0: "No error",
+	-100: "Command error",
+	-120: "Numeric argument error",
+	-139: "Missing non numeric argument",
+	-211: "Legal command, but settings conflict",
+	-212: "Argument out of range",
+	-222: "Insufficient capability or configuration",
+	-240: "Mass Memory error",
+	-241: "Mass storage device not present",
+	-246: "File name not found",
+	-247: "Duplicate file name",
+	-350: "Too Many Errors"}
+
+# Mainframe command tree. Lowercase letters can be left out, '#' stands for a
+# numeric suffix (MESE<N> etc.) and a trailing '?' marks a query.
+COMMANDS = [("*CLS", "cls"), ("*ESE", "ese"), ("*ESE?", "ese_q"), ("*ESR?", "esr_q"),
+	("*IDN?", "idn_q"), ("*IST?", "ist_q"), ("*OPC", "opc"), ("*OPC?", "opc_q"),
+	("*OPT?", "opt_q"), ("*PRE", "pre"), ("*PRE?", "pre_q"), ("*RST", "rst"),
+	("*SRE", "sre"), ("*SRE?", "sre_q"), ("*STB?", "stb_q"), ("*TRG", "nop"),
+	("*TST?", "tst_q"), ("*WAI", "wai"),
+	("BEEPer", "beeper"), ("BEEPer?", "beeper_q"), ("CAPability?", "capability_q"),
+	("CARDcage?", "cardcage_q"), ("CESE", "cese"), ("CESE?", "cese_q"), ("CESR?", "zero_q"),
+	("EOI", "eoi"), ("EOI?", "eoi_q"), ("LER?", "ler_q"), ("LOCKout", "lockout"),
+	("LOCKout?", "lockout_q"), ("MENU", "menu"), ("MENU?", "menu_q"), ("MESE#", "mese"),
+	("MESE#?", "mese_q"), ("MESR#?", "zero_q"), ("RMODe", "rmode"), ("RMODe?", "rmode_q"),
+	("RTC", "rtc"), ("RTC?", "rtc_q"), ("SELect", "select"), ("SELect?", "select_q"),
+	("SETColor", "setcolor"), ("SETColor?", "setcolor_q"), ("STARt", "start"),
+	("STOP", "stop"), ("XWINdow", "nop"),
+	("SYSTem:DATA", "data"), ("SYSTem:DATA?", "data_q"), ("SYSTem:DSP", "dsp"),
+	("SYSTem:ERRor?", "error_q"), ("SYSTem:HEADer", "header"), ("SYSTem:HEADer?", "header_q"),
+	("SYSTem:LONGform", "longform"), ("SYSTem:LONGform?", "longform_q"),
+	("SYSTem:PRINt", "print"), ("SYSTem:PRINt?", "print_q"), ("SYSTem:SETup", "setup"),
+	("SYSTem:SETup?", "setup_q"),
+	("MMEMory:AUToload", "autoload"), ("MMEMory:AUToload?", "autoload_q"),
+	("MMEMory:CATalog?", "catalog_q"), ("MMEMory:CD", "cd"), ("MMEMory:COPY", "copy"),
+	("MMEMory:DOWNload", "download"), ("MMEMory:INITialize", "initialize"),
+	("MMEMory:LOAD:CONFig", "load"), ("MMEMory:LOAD:IASSembler", "load"),
+	("MMEMory:MKDir", "mkdir"), ("MMEMory:MSI", "msi"), ("MMEMory:MSI?", "msi_q"),
+	("MMEMory:PACK", "nop"), ("MMEMory:PURGe", "purge"), ("MMEMory:PWD?", "pwd_q"),
+	("MMEMory:REName", "rename"), ("MMEMory:STORe", "store"), ("MMEMory:UPLoad?", "upload_q"),
+	("MMEMory:VOLume?", "volume_q"),
+	("INTermodule:DELete", "inter_delete"), ("INTermodule:HTIMe?", "ttime_q"),
+	("INTermodule:INPort", "inport"), ("INTermodule:INPort?", "inport_q"),
+	("INTermodule:INSert", "inter_insert"), ("INTermodule:PORTEDGE", "portedge"),
+	("INTermodule:PORTEDGE?", "portedge_q"), ("INTermodule:PORTLEV", "portlev"),
+	("INTermodule:PORTLEV?", "portlev_q"), ("INTermodule:SKEW#", "skew"),
+	("INTermodule:SKEW#?", "skew_q"), ("INTermodule:TREE", "tree"), ("INTermodule:TREE?", "tree_q"),
+	("INTermodule:TTIMe?", "ttime_q")]
+
+
+def match(token, mnemonic):
+	"""Check whether a header node such as 'SYST' or 'mese2?' matches a mnemonic such
+	as 'SYSTem' or 'MESE#?' in its short or long form.
+
+	Returns:
+	(True, suffix) where suffix is the numeric suffix or None, or (False, None)
+
+	"""
+	token = token.upper()
+	query = mnemonic.endswith("?")
+	if token.endswith("?") != query:
+		return False, None
+	token = token.rstrip("?")
+	mnemonic = mnemonic.rstrip("?")
+	suffix = None
+	if mnemonic.endswith("#"):
+		mnemonic = mnemonic[:-1]
+		digits = len(token) - len(token.rstrip("0123456789"))
+		if digits:
+			suffix = int(token[-digits:])
+			token = token[:-digits]
+	short = mnemonic.rstrip("abcdefghijklmnopqrstuvwxyz")
+	if token in (short, mnemonic.upper()):
+		return True, suffix
+	return False, None
+
+
+def pcx_image(width = 576, height = 368):
+	"""A color PCX image of the given size with some stripes on it, standing in for
+	screen prints.
+
+	"""
+	header = struct.pack("<BBBBHHHHHH48sBBHHHH54s", 10, 5, 1, 8, 0, 0, width - 1, height - 1, 72, 72, "", 0, 1, width, 1, 0, 0, "")
+	rows = []
+	for y in range(height):
+		row = []
+		x = 0
+		while x < width: # run-length encoded, at most 63 pixels per run
+			run = min(63, width - x)
+			row.append(chr(0xc0 | run) + chr((x / 63 + y / 16) % 8))
+			x += run
+		rows.append("".join(row))
+	palette = "".join(chr(r) + chr(g) + chr(b) for r, g, b in [(0, 0, 0), (255, 255, 255), (0, 255, 255), (255, 255, 0), (0, 255, 0), (255, 0, 255), (255, 0, 0), (0, 0, 255)])
+	return header + "".join(rows) + "\x0c" + palette.ljust(768, "\0")
+
+
+def split_args(string):
+	"""Split an argument string on commas that aren't inside quotes."""
+	args = []
+	current = []
+	quote = None
+	for c in string:
+		if quote:
+			if c == quote:
+				quote = None
+		elif c in "'\"":
+			quote = c
+		elif c == ",":
+			args.append("".join(current).strip())
+			current = []
+			continue
+		current.append(c)
+	args.append("".join(current).strip())
+	return args if args != [""] else []
+
+
+def unquote(string):
+	"""Remove quotes around a string argument."""
+	if len(string) > 1 and string[0] == string[-1] and string[0] in "'\"":
+		return string[1:-1]
+	return string
+
+
+class SimEntry:
+	"""A file or a directory on a simulated disk."""
+
+	def __init__(self, name, filetype = -5813, description = "", data = "", directory = False):
+		self.name = name
+		self.type = filetype
+		self.description = description
+		self.data = data
+		self.mtime = datetime.now()
+		self.children = {} if directory else None
+
+
+class SimLink:
+	"""One connection to the simulator: the input buffer and line rate pacing for
+	both directions.
+
+	"""
+
+	def __init__(self, port, baud):
+		self.port = port
+		self.rate = baud / 10.0 if baud else 0
+		self.inbuf = ""
+		self.pos = 0
+		self.rxclock = self.txclock = time.time()
+
+	def pace(self, clock, nbytes):
+		"""Advance a line clock by the time 'nbytes' take on the wire and sleep until
+		the line would be free again. Returns the new clock.
+
+		"""
+		now = time.time()
+		if not self.rate:
+			return now
+		clock = max(clock, now) + nbytes / self.rate
+		if clock > now:
+			time.sleep(clock - now)
+		return clock
+
+	def fill(self):
+		"""Wait for more input from the controller."""
+		self.port.wait(None)
+		data = self.port.recv(65536)
+		if not data:
+			raise EOFError
+		self.inbuf = self.inbuf[self.pos:] + data
+		self.pos = 0
+		self.rxclock = self.pace(self.rxclock, len(data))
+
+	def getc(self):
+		if self.pos >= len(self.inbuf):
+			self.fill()
+		c = self.inbuf[self.pos]
+		self.pos += 1
+		return c
+
+	def get(self, size):
+		chunks = []
+		while size > 0:
+			if self.pos >= len(self.inbuf):
+				self.fill()
+			chunk = self.inbuf[self.pos:self.pos + size]
+			self.pos += len(chunk)
+			size -= len(chunk)
+			chunks.append(chunk)
+		return "".join(chunks)
+
+	def write(self, data):
+		step = max(1, int(self.rate / 50)) if self.rate else len(data)
+		for i in range(0, len(data), step):
+			chunk = data[i:i + step]
+			self.port.write(chunk)
+			self.txclock = self.pace(self.txclock, len(chunk))
+
+	def read_message(self):
+		"""Read one program message (up to a newline) and split it into message
+		units. Block data arguments (#<n><length><data>) are read as they are.
+
+		Returns:
+		A list of (text, block) tuples, block is None for units without block data
+
+		"""
+		units = []
+		current = []
+		block = None
+		quote = None
+		while True:
+			c = self.getc()
+			if quote:
+				if c == quote:
+					quote = None
+				current.append(c)
+			elif c in "'\"":
+				quote = c
+				current.append(c)
+			elif c == "#":
+				numdigits = int(self.getc())
+				block = self.get(int(self.get(numdigits)))
+			elif c == ";" or c == "\n":
+				text = "".join(current).strip()
+				if text or block is not None:
+					units.append((text, block))
+				current = []
+				block = None
+				if c == "\n":
+					return units
+			else:
+				current.append(c)
+
+
+class HPSim:
+	"""Simulated HP 16500B mainframe.
+
+	Arguments:
+	baud		-- line rate to throttle the I/O to (10 bits per byte), 0 or None
+			   for no limit
+	disk_latency	-- seconds each disk operation takes
+	cmd_latency	-- seconds it takes to parse a program message
+	cards		-- card ID numbers in the card cage, -1 for an empty slot (see
+			   HPLA.installed_modules), 5 or 10 slots
+	assignment	-- module assignment of each card
+	datasize	-- size of the made-up acquisition data and setup blocks
+	screensize	-- size of the made-up screen prints that aren't PCX
+	verbose		-- print the received messages
+
+	"""
+
+	def __init__(self, baud = 19200, disk_latency = 0.2, cmd_latency = 0.002, cards = None, assignment = None, datasize = 16384, screensize = 30000, verbose = False):
+		self.baud = baud
+		self.disk_latency = disk_latency
+		self.cmd_latency = cmd_latency
+		self.cards = cards or [-1, -1, 31, 32, 33]
+		self.assignment = assignment or [0, 0, 3, 4, 4]
+		self.datasize = datasize
+		self.screensize = screensize
+		self.verbose = verbose
+		self.lock = threading.Lock()
+		self.disks = {"INT0": SimEntry("\\", directory = True), "INT1": SimEntry("\\", directory = True)}
+		self.reset()
+
+	def reset(self):
+		"""Put the mainframe into its power-on state (the disks are kept)."""
+		self.errors = []
+		self.esr = 128 # PON
+		self.ese = self.sre = self.pre = self.cese = 0
+		self.mese = {}
+		self.opc_armed = False
+		self.busy_until = 0
+		self.menu = (0, 0)
+		self.selected = 0
+		self.beeper = 1
+		self.eoi = 1
+		self.lockout = 0
+		self.rmode = "SINGLE"
+		self.clock_offset = timedelta(0)
+		self.colors = dict(DEFAULT_COLORS)
+		self.headers = 0
+		self.longform = 0
+		self.msi = "INT0"
+		self.cwd = {"INT0": [], "INT1": []}
+		self.autoload = "0"
+		self.inport = 0
+		self.portedge = 1
+		self.portlev = "TTL"
+		self.skew = {}
+		self.tree = [-1] * len(self.cards)
+		self.running = False
+		self.data = {}
+		self.setup = {}
+		self.display = []
+
+	# Running
+
+	def connect(self, timeout = None):
+		"""Serve on an in-process pipe in a background thread.
+
+		Returns:
+		PipeTransport for the controller end, to be passed to HPLA
+
+		"""
+		controller, instrument = PipeTransport.pair(timeout)
+		self.start(instrument)
+		return controller
+
+	def openpty(self):
+		"""Serve on a new pseudo-terminal in a background thread.
+
+		Returns:
+		Device name of the terminal, to be passed to HPLA
+
+		"""
+		master, slave = os.openpty()
+		tty.setraw(slave)
+		self.slave = slave # keep the terminal around between clients
+		self.start(PipeTransport(master, master))
+		return os.ttyname(slave)
+
+	def start(self, transport):
+		t = threading.Thread(target = self.serve, args = (transport,))
+		t.daemon = True
+		t.start()
+		return t
+
+	def serve(self, transport):
+		"""Process program messages from a transport until it's closed."""
+		link = SimLink(transport, self.baud)
+		try:
+			while True:
+				units = link.read_message()
+				if self.verbose:
+					print "[" + str(time.time()) + "\thpsim]\t" + "; ".join(text + (" <block of " + str(len(block)) + " bytes>" if block is not None else "") for text, block in units)
+				if self.cmd_latency:
+					time.sleep(self.cmd_latency)
+				with self.lock:
+					responses = self.execute(units)
+				if responses:
+					link.write(";".join(responses) + "\n")
+		except (EOFError, IOError, OSError):
+			pass
+
+	def execute(self, units):
+		"""Execute the message units of one program message.
+
+		Returns:
+		List of query responses
+
+		"""
+		responses = []
+		branch = []
+		for text, block in units:
+			parts = text.split(None, 1)
+			header = parts[0] if parts else ""
+			args = split_args(parts[1]) if len(parts) > 1 else []
+			nodes = [n for n in header.split(":") if n]
+			if header.startswith(":") or header.startswith("*"):
+				candidates = [nodes]
+			else: # relative to the subsystem of the previous command
+				candidates = [branch + nodes, nodes]
+			for path in candidates:
+				handler, suffix = self.lookup(path)
+				if handler:
+					if not header.startswith("*"): # common commands don't move the parser
+						branch = path[:-1]
+					break
+			if not handler:
+				self.error(-100)
+				continue
+			try:
+				r = handler(args, block, suffix)
+			except ValueError:
+				self.error(-120)
+			except IndexError:
+				self.error(-139)
+			else:
+				if r is not None:
+					responses.append(str(r))
+		return responses
+
+	def lookup(self, nodes):
+		"""Find the handler method of a command header split into nodes."""
+		for mnemonic, name in COMMANDS:
+			parts = mnemonic.split(":")
+			if len(parts) != len(nodes):
+				continue
+			suffix = None
+			for token, part in zip(nodes, parts):
+				ok, s = match(token, part)
+				if not ok:
+					break
+				if s is not None:
+					suffix = s
+			else:
+				return getattr(self, "c_" + name), suffix
+		return None, None
+
+	# Helpers
+
+	def error(self, code):
+		"""Put an error into the error queue and set the matching event status bit."""
+		if len(self.errors) >= 30:
+			self.errors[-1] = -350
+		else:
+			self.errors.append(code)
+		if -200 < code <= -100:
+			self.esr |= 32 # CME
+		elif -300 < code <= -200:
+			self.esr |= 16 # EXE
+		elif -500 < code <= -400:
+			self.esr |= 4 # QYE
+		else:
+			self.esr |= 8 # DDE
+
+	def block(self, data):
+		return "#8" + "%08d" % len(data) + data
+
+	def busy(self):
+		"""Start an overlapped disk operation."""
+		self.busy_until = max(self.busy_until, time.time()) + self.disk_latency
+
+	def wait_busy(self):
+		"""Wait for overlapped operations to finish."""
+		delay = self.busy_until - time.time()
+		if delay > 0:
+			time.sleep(delay)
+		self.complete()
+
+	def complete(self):
+		if self.opc_armed and time.time() >= self.busy_until:
+			self.esr |= 1 # OPC
+			self.opc_armed = False
+
+	def modules(self):
+		"""Module numbers of the installed cards."""
+		return sorted(set(m for card, m in zip(self.cards, self.assignment) if card >= 0 and m > 0))
+
+	def madeup(self, size, seed):
+		"""Deterministic filler data."""
+		pattern = "".join(chr((seed * 31 + i * 7) % 256) for i in range(256))
+		return (pattern * (size / 256 + 1))[:size]
+
+	def drive(self, msus):
+		"""Normalize a Mass Storage Unit Specifier, None means the current one."""
+		if not msus:
+			return self.msi
+		msus = msus.upper()
+		if not (msus.startswith("INT") and msus[-1] in "01"):
+			raise ValueError(msus)
+		return "INT" + msus[-1]
+
+	def resolve(self, name, msus = None, parent = False):
+		"""Find a disk entry by path. With parent = True, returns the directory the
+		entry is in and the last path component instead.
+
+		"""
+		drive = self.drive(msus)
+		path = unquote(name).upper().replace("/", "\\")
+		parts = [] if path.startswith("\\") else list(self.cwd[drive])
+		for p in path.split("\\"):
+			if p == "..":
+				parts = parts[:-1]
+			elif p and p != ".":
+				parts.append(p)
+		if parent:
+			parts, last = parts[:-1], (parts[-1] if parts else "")
+		entry = self.disks[drive]
+		for p in parts:
+			entry = entry.children.get(p) if entry.children is not None else None
+			if entry is None:
+				return (None, None) if parent else None
+		return (entry, last) if parent else entry
+
+	def split_msus(self, args, count):
+		"""Split off an optional msus after the first argument of a disk command that
+		has 'count' arguments without it.
+
+		"""
+		if len(args) > count and not args[1].startswith(("'", '"')):
+			return args[:1] + args[2:], args[1]
+		return args, None
+
+	# Common commands
+
+	def c_nop(self, args, block, n):
+		pass
+
+	def c_cls(self, args, block, n):
+		self.errors = []
+		self.esr = 0
+
+	def c_ese(self, args, block, n):
+		self.ese = int(args[0])
+
+	def c_ese_q(self, args, block, n):
+		return self.ese
+
+	def c_esr_q(self, args, block, n):
+		self.complete()
+		esr, self.esr = self.esr, 0
+		return esr
+
+	def c_idn_q(self, args, block, n):
+		return IDN
+
+	def c_ist_q(self, args, block, n):
+		return 1 if self.stb() & self.pre else 0
+
+	def c_opc(self, args, block, n):
+		self.opc_armed = True
+		self.complete()
+
+	def c_opc_q(self, args, block, n):
+		self.wait_busy()
+		return 1
+
+	def c_opt_q(self, args, block, n):
+		return ",".join(["0"] * 9)
+
+	def c_pre(self, args, block, n):
+		self.pre = int(args[0])
+
+	def c_pre_q(self, args, block, n):
+		return self.pre
+
+	def c_rst(self, args, block, n):
+		pass # no effect on the HP 16500B
+
+	def c_sre(self, args, block, n):
+		self.sre = int(args[0])
+
+	def c_sre_q(self, args, block, n):
+		return self.sre
+
+	def stb(self):
+		self.complete()
+		return (32 if self.esr & self.ese else 0) | (1 if self.running else 0)
+
+	def c_stb_q(self, args, block, n):
+		return self.stb()
+
+	def c_tst_q(self, args, block, n):
+		return 0
+
+	def c_wai(self, args, block, n):
+		self.wait_busy()
+
+	# Mainframe commands
+
+	def c_beeper(self, args, block, n):
+		if args:
+			self.beeper = 1 if args[0].upper() in ("1", "ON") else 0
+
+	def c_beeper_q(self, args, block, n):
+		return self.beeper
+
+	def c_capability_q(self, args, block, n):
+		return CAPABILITY
+
+	def c_cardcage_q(self, args, block, n):
+		return ",".join(str(x) for x in self.cards + self.assignment)
+
+	def c_cese(self, args, block, n):
+		self.cese = int(args[0])
+
+	def c_cese_q(self, args, block, n):
+		return self.cese
+
+	def c_zero_q(self, args, block, n):
+		return 0
+
+	def c_eoi(self, args, block, n):
+		self.eoi = 1 if args[0].upper() in ("1", "ON") else 0
+
+	def c_eoi_q(self, args, block, n):
+		return self.eoi
+
+	def c_ler_q(self, args, block, n):
+		return 0
+
+	def c_lockout(self, args, block, n):
+		self.lockout = 1 if args[0].upper() in ("1", "ON") else 0
+
+	def c_lockout_q(self, args, block, n):
+		return self.lockout
+
+	def c_menu(self, args, block, n):
+		module = int(args[0])
+		menu = int(args[1]) if len(args) > 1 else 0
+		if (module == 0 or module in self.modules()) and 0 <= menu <= 5:
+			self.menu = (module, menu)
+		else:
+			self.error(-211)
+
+	def c_menu_q(self, args, block, n):
+		return "%d,%d" % self.menu
+
+	def c_mese(self, args, block, n):
+		self.mese[n] = int(args[0])
+
+	def c_mese_q(self, args, block, n):
+		return self.mese.get(n, 0)
+
+	def c_rmode(self, args, block, n):
+		self.rmode = "REPETITIVE" if args[0].upper().startswith("REP") else "SINGLE"
+
+	def c_rmode_q(self, args, block, n):
+		return self.rmode
+
+	def c_rtc(self, args, block, n):
+		d, m, y, h, mi, s = [int(a) for a in args]
+		self.clock_offset = datetime(y, m, d, h, mi, s) - datetime.now()
+
+	def c_rtc_q(self, args, block, n):
+		t = datetime.now() + self.clock_offset
+		return "%d,%d,%d,%d,%d,%d" % (t.day, t.month, t.year, t.hour, t.minute, t.second)
+
+	def c_select(self, args, block, n):
+		module = int(args[0])
+		if module == 0 or module in self.modules():
+			self.selected = module
+		else:
+			self.error(-211)
+
+	def c_select_q(self, args, block, n):
+		return self.selected
+
+	def c_setcolor(self, args, block, n):
+		if args[0].upper().startswith("DEF"):
+			self.colors = dict(DEFAULT_COLORS)
+		else:
+			color, hue, sat, lum = [int(a) for a in args]
+			if color not in self.colors:
+				self.error(-212)
+			else:
+				self.colors[color] = (hue, sat, lum)
+
+	def c_setcolor_q(self, args, block, n):
+		color = int(args[0])
+		return ",".join(str(x) for x in (color,) + self.colors.get(color, (0, 0, 0)))
+
+	def c_start(self, args, block, n):
+		self.running = True
+
+	def c_stop(self, args, block, n):
+		self.running = False
+
+	# SYSTem subsystem
+
+	def c_data(self, args, block, n):
+		self.data[self.selected] = block or ""
+
+	def c_data_q(self, args, block, n):
+		return self.block(self.data.get(self.selected, self.madeup(self.datasize, self.selected)))
+
+	def c_dsp(self, args, block, n):
+		self.display = (self.display + [unquote(args[0])])[-5:]
+
+	def c_error_q(self, args, block, n):
+		code = self.errors.pop(0) if self.errors else 0
+		if args and args[0].upper().startswith("STR"):
+			return str(code) + ',"' + ERRORS.get(code, "Error") + '"'
+		return code
+
+	def c_header(self, args, block, n):
+		self.headers = 1 if args[0].upper() in ("1", "ON") else 0
+
+	def c_header_q(self, args, block, n):
+		return self.headers
+
+	def c_longform(self, args, block, n):
+		self.longform = 1 if args[0].upper() in ("1", "ON") else 0
+
+	def c_longform_q(self, args, block, n):
+		return self.longform
+
+	def c_print(self, args, block, n):
+		upper = [a.upper() for a in args]
+		if "DISK" not in upper:
+			return # no printer on HP-IB
+		i = upper.index("DISK")
+		name = unquote(args[i + 1])
+		rest = args[i + 2:]
+		msus = rest[0] if rest and rest[0].upper().startswith("INT") else None
+		filetype = rest[-1].upper() if rest and not rest[-1].upper().startswith("INT") else "PCX"
+		if "." not in name.split("\\")[-1]:
+			name += ".TIF" if filetype.endswith("TIF") else "." + filetype
+		image = pcx_image() if filetype == "PCX" else self.madeup(self.screensize, 42)
+		self.write_file(name, msus, image, -5813, "")
+		self.busy()
+
+	def c_print_q(self, args, block, n):
+		return self.madeup(self.screensize / 4, 7)
+
+	def c_setup(self, args, block, n):
+		self.setup[self.selected] = block or ""
+
+	def c_setup_q(self, args, block, n):
+		return self.block(self.setup.get(self.selected, self.madeup(self.datasize / 4, 100 + self.selected)))
+
+	# MMEMory subsystem
+
+	def write_file(self, name, msus, data, filetype, description):
+		directory, last = self.resolve(name, msus, parent = True)
+		if directory is None or directory.children is None or not last:
+			self.error(-246)
+			return
+		entry = directory.children.get(last)
+		if entry is not None and entry.children is not None:
+			self.error(-247)
+			return
+		directory.children[last] = SimEntry(last, filetype, description, data)
+
+	def c_autoload(self, args, block, n):
+		self.autoload = "0" if args[0].upper() in ("0", "OFF") else args[0]
+
+	def c_autoload_q(self, args, block, n):
+		return self.autoload
+
+	def c_catalog_q(self, args, block, n):
+		long = bool(args) and args[0].upper() == "ALL"
+		msus = args[1] if long and len(args) > 1 else (args[0] if args and not long else None)
+		directory = self.resolve(".", msus)
+		time.sleep(self.disk_latency)
+		listing = []
+		for name in sorted(directory.children):
+			e = directory.children[name]
+			filetype = DIRECTORY_TYPE if e.children is not None else str(e.type)
+			if long:
+				stamp = e.mtime.strftime("%d") + MONTHS[e.mtime.month - 1] + e.mtime.strftime("%y %H:%M:%S")
+				listing.append("%-12s %7s %-32s %s" % (name[:12], filetype, e.description[:32], stamp))
+			else:
+				listing.append("%-10s %7s %-32s" % (name[:10], filetype, e.description[:32]))
+		return self.block("".join(listing))
+
+	def c_cd(self, args, block, n):
+		drive = self.drive(args[1] if len(args) > 1 else None)
+		entry = self.resolve(args[0], drive)
+		if entry is None or entry.children is None:
+			self.error(-246)
+			return
+		path = unquote(args[0]).upper().replace("/", "\\")
+		parts = [] if path.startswith("\\") else list(self.cwd[drive])
+		for p in path.split("\\"):
+			if p == "..":
+				parts = parts[:-1]
+			elif p and p != ".":
+				parts.append(p)
+		self.cwd[drive] = parts
+
+	def c_copy(self, args, block, n):
+		name, srcmsus, newname, dstmsus = (args + [None] * 4)[:4]
+		if srcmsus and srcmsus.startswith(("'", '"')):
+			name, srcmsus, newname, dstmsus = args[0], None, args[1], (args[2] if len(args) > 2 else None)
+		entry = self.resolve(name, srcmsus)
+		if entry is None or entry.children is not None:
+			self.error(-246)
+			return
+		time.sleep(self.disk_latency)
+		self.write_file(newname, dstmsus, entry.data, entry.type, entry.description)
+
+	def c_download(self, args, block, n):
+		args, msus = self.split_msus(args, 3)
+		self.write_file(args[0], msus, block or "", int(args[2]), unquote(args[1]))
+		self.busy()
+
+	def c_initialize(self, args, block, n):
+		drive = self.drive(args[-1] if args and args[-1].upper().startswith("INT") else "INT1")
+		self.disks[drive] = SimEntry("\\", directory = True)
+		self.cwd[drive] = []
+		self.busy()
+
+	def c_load(self, args, block, n):
+		args, msus = self.split_msus(args, 1)
+		if self.resolve(args[0], msus) is None:
+			self.error(-246)
+		else:
+			self.busy()
+
+	def c_mkdir(self, args, block, n):
+		directory, last = self.resolve(args[0], args[1] if len(args) > 1 else None, parent = True)
+		if directory is None or directory.children is None or not last:
+			self.error(-246)
+		elif last in directory.children:
+			self.error(-247)
+		else:
+			directory.children[last] = SimEntry(last, directory = True)
+
+	def c_msi(self, args, block, n):
+		self.msi = self.drive(args[0])
+
+	def c_msi_q(self, args, block, n):
+		return self.msi
+
+	def c_purge(self, args, block, n):
+		directory, last = self.resolve(args[0], args[1] if len(args) > 1 else None, parent = True)
+		if directory is None or directory.children is None or last not in directory.children:
+			self.error(-246)
+		else:
+			del directory.children[last]
+			self.busy()
+
+	def c_pwd_q(self, args, block, n):
+		drive = self.drive(args[0] if args else None)
+		return '"\\' + "\\".join(self.cwd[drive]) + '",' + drive
+
+	def c_rename(self, args, block, n):
+		args, msus = self.split_msus(args, 2)
+		directory, last = self.resolve(args[0], msus, parent = True)
+		newname = unquote(args[1]).upper()
+		if directory is None or directory.children is None or last not in directory.children:
+			self.error(-246)
+		elif newname in directory.children:
+			self.error(-247)
+		else:
+			entry = directory.children.pop(last)
+			entry.name = newname
+			directory.children[newname] = entry
+
+	def c_store(self, args, block, n):
+		args, msus = self.split_msus(args, 2)
+		self.write_file(args[0], msus, self.madeup(self.datasize / 4, 100 + self.selected), -16127, unquote(args[1]))
+		self.busy()
+
+	def c_upload_q(self, args, block, n):
+		entry = self.resolve(args[0], args[1] if len(args) > 1 else None)
+		time.sleep(self.disk_latency)
+		if entry is None or entry.children is not None:
+			self.error(-246)
+			return None
+		return self.block(entry.data)
+
+	def c_volume_q(self, args, block, n):
+		self.drive(args[0] if args else None)
+		return "DOS"
+
+	# INTermodule subsystem
+
+	def c_inter_delete(self, args, block, n):
+		module = int(args[0])
+		if module < len(self.tree):
+			self.tree[module] = -1
+
+	def c_inter_insert(self, args, block, n):
+		module = int(args[0])
+		location = args[1].upper()
+		if module < len(self.tree):
+			self.tree[module] = 0 if location.startswith("GROUP") else int(location)
+
+	def c_inport(self, args, block, n):
+		self.inport = 1 if args[0].upper() in ("1", "ON") else 0
+
+	def c_inport_q(self, args, block, n):
+		return self.inport
+
+	def c_portedge(self, args, block, n):
+		self.portedge = 1 if args[0].upper() in ("1", "ON") else 0
+
+	def c_portedge_q(self, args, block, n):
+		return self.portedge
+
+	def c_portlev(self, args, block, n):
+		self.portlev = args[0].upper()
+
+	def c_portlev_q(self, args, block, n):
+		return self.portlev if "L" in self.portlev else '"' + self.portlev + 'V"'
+
+	def c_skew(self, args, block, n):
+		self.skew[n] = float(args[0])
+
+	def c_skew_q(self, args, block, n):
+		return repr(self.skew.get(n, 0.0))
+
+	def c_tree(self, args, block, n):
+		self.tree = [int(a) for a in args]
+
+	def c_tree_q(self, args, block, n):
+		return ",".join(str(t) for t in self.tree)
+
+	def c_ttime_q(self, args, block, n):
+		return ",".join(["9.9E37"] * len(self.cards))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Simulated HP 16500B mainframe on a pseudo-terminal.")
+	parser.add_argument("--baud", type = int, default = 19200, help = "line rate to throttle to, 0 for no limit")
+	parser.add_argument("--disk-latency", type = float, default = 0.2, help = "seconds per disk operation")
+	parser.add_argument("--cmd-latency", type = float, default = 0.002, help = "seconds to parse a message")
+	parser.add_argument("--verbose", action = "store_true", help = "print received messages")
+	opts = parser.parse_args()
+	sim = HPSim(baud = opts.baud, disk_latency = opts.disk_latency, cmd_latency = opts.cmd_latency, verbose = opts.verbose)
+	print "Simulated HP 16500B on " + sim.openpty()
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		pass